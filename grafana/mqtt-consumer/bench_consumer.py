@@ -0,0 +1,277 @@
+import argparse
+import email.utils
+import http.server
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+
+import consumer
+from fleet_simulator import FleetSimulator, chirpstack_payload
+from publisher import MetricsPublisher
+
+'''
+Benchmark of the consumer pipeline, replaying uplinks through on_message
+
+Prometheus, the Pushgateway and nginx are replaced by a local HTTP server in the same process,
+the uplinks come from the fleet simulator (or are recorded, one ChirpStack JSON payload by line with --replay).
+Reports the messages per second, p50 / p99 of each stage and the peak RSS, for each fleet size
+(each fleet size runs in its own process, so the peak RSS is not shared)
+
+Usage: python bench_consumer.py [--fleet 10 100 1000] [--messages 2000] [--rate 0] [--clock simulated|wall] [--mode inline|workers|batch]
+'''
+
+DATAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'datas')
+
+# Functions of consumer.py timed by the benchmark
+STAGES = ['get_previous_values', 'data_merging', 'check_collision', 'check_collision_cpa', 'check_collisions_cpa', 'check_close_approach', 'check_close_approach_device', 'check_state']
+
+#############################################################################################
+#                                    LOCAL STAND-INS                                        #
+#############################################################################################
+
+'''
+Prometheus (empty results), Pushgateway (accepts every push) and nginx (zone files of 'zones_dir') in one HTTP server
+'''
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    zones_dir = DATAS
+    requests = {}
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/api/v1/query':
+            self._count('prometheus')
+            return self._send_json({'status': 'success', 'data': {'resultType': 'vector', 'result': []}})
+        if path == '/api/v1/query_range':
+            self._count('prometheus')
+            return self._send_json({'status': 'success', 'data': {'resultType': 'matrix', 'result': []}})
+        if path == '/metrics':
+            self._count('pushgateway')
+            return self._send(b'')
+        if path == '/list_files/':
+            self._count('nginx')
+            return self._send_json([
+                {'name': name, 'type': 'file', 'mtime': email.utils.formatdate(os.path.getmtime(os.path.join(self.zones_dir, name)), usegmt=True)}
+                for name in self._zone_files()
+            ])
+        name = os.path.basename(path)
+        if name in self._zone_files():
+            self._count('nginx')
+            with open(os.path.join(self.zones_dir, name), 'rb') as file:
+                return self._send(file.read())
+        self.send_response(404)
+        self.end_headers()
+
+    def do_PUT(self):
+        self._count('pushgateway')
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._send(b'')
+
+    do_POST = do_PUT
+
+    def _zone_files(self):
+        if not os.path.isdir(self.zones_dir):
+            return []
+        return sorted(name for name in os.listdir(self.zones_dir) if name.endswith('.geojson'))
+
+    def _count(self, target):
+        StandInHandler.requests[target] = StandInHandler.requests.get(target, 0) + 1
+
+    def _send_json(self, data):
+        self._send(json.dumps(data).encode())
+
+    def _send(self, body):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+'''
+Start the stand-in server in a thread, return its URL
+'''
+def start_stand_ins(zones_dir):
+    StandInHandler.zones_dir = zones_dir
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, name='stand-ins')
+    thread.daemon = True
+    thread.start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+#############################################################################################
+#                                        UPLINKS                                            #
+#############################################################################################
+
+'''
+MQTT message as given to on_message, with the date of the uplink in the simulation (None if recorded)
+'''
+class Message:
+    __slots__ = ('topic', 'payload', 'date')
+
+    def __init__(self, topic, payload, date=None):
+        self.topic = topic
+        self.payload = payload
+        self.date = date
+
+'''
+Synthetic uplinks of 'fleet' boats on the Han river (see fleet_simulator.py)
+'''
+def synthetic_uplinks(fleet, messages, seed=0):
+    simulator = FleetSimulator(fleet, seed)
+    uplinks = []
+    for uplink in simulator.uplinks():
+        payload = chirpstack_payload(uplink)
+        uplinks.append(Message(f"application/{consumer.APP_NUMBER}/device/{payload['devEUI']}/event/up", json.dumps(payload).encode(), uplink['date']))
+        if len(uplinks) >= messages:
+            break
+    return uplinks
+
+'''
+Recorded uplinks: one ChirpStack JSON payload by line
+'''
+def recorded_uplinks(file_name, messages):
+    uplinks = []
+    with open(file_name) as file:
+        for line in file:
+            if line.strip() == '':
+                continue
+            payload = json.loads(line)
+            dev_eui = payload.get('devEUI', payload.get('deviceName', 'unknown'))
+            uplinks.append(Message(f'application/{consumer.APP_NUMBER}/device/{dev_eui}/event/up', line.strip().encode()))
+    return uplinks[:messages] if messages else uplinks
+
+#############################################################################################
+#                                       BENCHMARK                                           #
+#############################################################################################
+
+'''
+Replace consumer.'name' by a version recording its durations in 'timings'
+'''
+def instrument(name, timings):
+    function = getattr(consumer, name)
+    durations = timings.setdefault(name, [])
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - start)
+
+    setattr(consumer, name, timed)
+    return timed
+
+def setup(args, url):
+    # the consumer prints every message, which would be most of the measure
+    consumer.print = lambda *args, **kwargs: None
+    consumer.PROMETHEUS = url
+    consumer.ZONE_REGISTRY.nginx_url = url
+    consumer.COLLISION_METHOD = args.collision
+    consumer.PREDICTION_METHOD = args.prediction
+    consumer.ZONE_REGISTRY.refresh()
+
+    timings = {}
+    for name in STAGES:
+        instrument(name, timings)
+    push_durations = timings.setdefault('push', [])
+
+    def timed_push(push):
+        def timed():
+            start = time.perf_counter()
+            try:
+                return push()
+            finally:
+                push_durations.append(time.perf_counter() - start)
+        return timed
+
+    consumer.METRICS_PUBLISHER = MetricsPublisher(
+        consumer.registry, url, 'data-ship', 'push', consumer.METRICS_PUSH_INTERVAL, consumer.METRICS_PUSH_MAX_PENDING,
+        http_client=consumer.HTTP_CLIENT, timer=timed_push
+    )
+
+    # the pushes are coalesced as in production ('inline' only keeps the processing in the caller thread)
+    consumer.METRICS_PUBLISHER.start()
+    if args.mode == 'batch':
+        consumer.INGEST_PIPELINE = consumer.MicroBatcher(instrument('process_batch', timings), args.window, consumer.INGEST_BATCH_MAX_SIZE, consumer.INGEST_BATCH_SIZE_METRIC, consumer.INGEST_BATCH_LATENCY_METRIC)
+        consumer.INGEST_PIPELINE.start()
+    else:
+        consumer.INGEST_PIPELINE.handler = instrument('process_uplink', timings)
+        if args.mode == 'workers':
+            consumer.INGEST_PIPELINE.start()
+    return timings
+
+def run(args, fleet):
+    url = start_stand_ins(args.zones)
+    timings = setup(args, url)
+    if args.replay:
+        uplinks = recorded_uplinks(args.replay, args.messages)
+    else:
+        uplinks = synthetic_uplinks(fleet, args.messages, args.seed)
+
+    on_message = timings.setdefault('on_message', [])
+    # simulated clock: the uplinks are received at their date in the simulation (shifted to now), so each
+    # boat keeps its reporting period whatever the replay rate
+    clock_offset = time.time() - (uplinks[0].date or 0) if len(uplinks) > 0 else 0
+    start = time.perf_counter()
+    for index, message in enumerate(uplinks):
+        if args.rate > 0:
+            delay = start + index / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        received = time.perf_counter()
+        if args.clock == 'simulated' and message.date is not None:
+            consumer.handle_payload(message.payload, clock_offset + message.date)
+        else:
+            consumer.on_message(None, None, message)
+        on_message.append(time.perf_counter() - received)
+    consumer.INGEST_PIPELINE.join()
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"fleet {fleet} boats, {len(uplinks)} messages in {elapsed:.2f} s: {len(uplinks) / elapsed:.1f} msg/s, peak RSS {peak_rss:.1f} MB ({args.mode}, {args.collision}, {args.prediction})")
+    print(f"{'stage':<28} {'calls':>8} {'p50 ms':>10} {'p99 ms':>10}")
+    for name, durations in timings.items():
+        if len(durations) == 0:
+            continue
+        p50, p99 = np.percentile(np.array(durations) * 1000, [50, 99])
+        print(f"{name:<28} {len(durations):>8} {p50:>10.3f} {p99:>10.3f}")
+    print(f"stand-in requests: {dict(sorted(StandInHandler.requests.items()))}")
+    print()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the consumer pipeline')
+    parser.add_argument('--fleet', type=int, nargs='+', default=[10, 100, 1000], help='fleet sizes (boats)')
+    parser.add_argument('--messages', type=int, default=2000, help='messages by fleet size')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second (0: as fast as possible)')
+    parser.add_argument('--clock', choices=['simulated', 'wall'], default='simulated', help='reception time of the synthetic uplinks: their date in the simulation, or the wall clock (the reporting period of the boats shrinks with the replay rate)')
+    parser.add_argument('--mode', choices=['inline', 'workers', 'batch'], default='inline', help='processing in the caller thread, by the ingest workers or in micro-batches')
+    parser.add_argument('--window', type=float, default=consumer.INGEST_BATCH_WINDOW, help='micro-batch window (s)')
+    parser.add_argument('--collision', choices=['corridor', 'cpa'], default=consumer.COLLISION_METHOD)
+    parser.add_argument('--prediction', choices=['spline', 'kalman'], default=consumer.PREDICTION_METHOD)
+    parser.add_argument('--replay', help='file of recorded uplinks (one ChirpStack JSON payload by line)')
+    parser.add_argument('--zones', default=DATAS, help='directory of the geojson zones served by the nginx stand-in')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    args = parse_args()
+    if len(args.fleet) == 1:
+        run(args, args.fleet[0])
+    else:
+        # one process by fleet size
+        argv = [arg for arg in sys.argv[1:]]
+        if '--fleet' in argv:
+            position = argv.index('--fleet')
+            end = position + 1
+            while end < len(argv) and not argv[end].startswith('--'):
+                end += 1
+            del argv[position:end]
+        for fleet in args.fleet:
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--fleet', str(fleet)] + argv, check=False)
@@ -0,0 +1,84 @@
+import math
+import time
+import numpy as np
+
+from geodesy import haversine_distance, destination_point, pairwise_distance_matrix
+
+'''
+Benchmark of the geodesy module against the scalar versions it replaced
+
+Usage: python bench_geodesy.py
+'''
+
+#############################################################################################
+#                                  SCALAR REFERENCE VERSIONS                                #
+#############################################################################################
+
+# Haversine of calculate_distance_speed (math, one point at a time)
+def scalar_haversine_distance(lat1, lon1, lat2, lon2):
+    R = 6371.0
+    lat1 = math.radians(lat1)
+    lon1 = math.radians(lon1)
+    lat2 = math.radians(lat2)
+    lon2 = math.radians(lon2)
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = math.sin(dlat / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2)**2
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    return R * c
+
+# move_point of consumer.py, called on scalar values
+def scalar_move_point(lat, lon, distance, bearing):
+    R = 6371.0
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    lat2 = np.arcsin(np.sin(lat) * np.cos(distance / R) + np.cos(lat) * np.sin(distance / R) * np.cos(bearing))
+    lon2 = lon + np.arctan2(np.sin(bearing) * np.sin(distance / R) * np.cos(lat), np.cos(distance / R) - np.sin(lat) * np.sin(lat2))
+    return np.degrees(lat2), np.degrees(lon2)
+
+#############################################################################################
+#                                         BENCHMARK                                         #
+#############################################################################################
+
+def measure(function, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def print_result(name, size, scalar_time, vector_time):
+    print(f"{name:<20} {size:>9} points   scalar {scalar_time * 1000:>10.3f} ms   vectorized {vector_time * 1000:>8.3f} ms   x{scalar_time / vector_time:>8.1f}")
+
+def run(sizes=(1, 1000, 1000000), seed=0):
+    rng = np.random.default_rng(seed)
+    for size in sizes:
+        # positions around the Han river
+        lat1 = rng.uniform(16.03, 16.10, size)
+        lon1 = rng.uniform(108.20, 108.25, size)
+        lat2 = rng.uniform(16.03, 16.10, size)
+        lon2 = rng.uniform(108.20, 108.25, size)
+        distances = rng.uniform(0.0, 0.5, size)
+        bearings = rng.uniform(-np.pi, np.pi, size)
+        repeat = 1 if size >= 1000000 else 3
+
+        lat1_list, lon1_list, lat2_list, lon2_list = lat1.tolist(), lon1.tolist(), lat2.tolist(), lon2.tolist()
+        scalar_time = measure(lambda: [scalar_haversine_distance(*point) for point in zip(lat1_list, lon1_list, lat2_list, lon2_list)], repeat)
+        vector_time = measure(lambda: haversine_distance(lat1, lon1, lat2, lon2), repeat)
+        expected = np.array([scalar_haversine_distance(*point) for point in zip(lat1_list[:1000], lon1_list[:1000], lat2_list[:1000], lon2_list[:1000])])
+        assert np.allclose(haversine_distance(lat1[:1000], lon1[:1000], lat2[:1000], lon2[:1000]), expected)
+        print_result('haversine_distance', size, scalar_time, vector_time)
+
+        scalar_time = measure(lambda: [scalar_move_point(*point) for point in zip(lat1, lon1, distances, bearings)], repeat)
+        vector_time = measure(lambda: destination_point(lat1, lon1, distances, bearings), repeat)
+        print_result('destination_point', size, scalar_time, vector_time)
+
+        # the distance matrix is quadratic in memory, only measured on a fleet sized sample
+        fleet = min(size, 1000)
+        scalar_time = measure(lambda: [[scalar_haversine_distance(a, b, c, d) for c, d in zip(lat1_list[:fleet], lon1_list[:fleet])] for a, b in zip(lat1_list[:fleet], lon1_list[:fleet])], 1)
+        vector_time = measure(lambda: pairwise_distance_matrix(lat1[:fleet], lon1[:fleet]), repeat)
+        print_result('distance_matrix', fleet, scalar_time, vector_time)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,45 @@
+from scipy.spatial import cKDTree
+import numpy as np
+
+from geodesy import EARTH_RADIUS_KM, haversine_distance, pairwise_distance_matrix
+
+# Under this number of boats the full distance matrix is computed, above a k-d tree is used
+DENSE_LIMIT = 32
+
+#############################################################################################
+#                                     CLOSE APPROACH                                        #
+#############################################################################################
+
+'''
+Find all pairs of points closer than 'radius' (km) in one pass over the fleet
+
+Small fleets use the full distance matrix (vectorized), large fleets a k-d tree over a local
+projection of the points, whose candidate pairs are checked with the haversine distance.
+Return (i, j, distances) arrays with i < j
+'''
+def close_pairs(latitudes, longitudes, radius, dense_limit=DENSE_LIMIT):
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    if len(latitudes) < 2:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0)
+
+    if len(latitudes) <= dense_limit:
+        distances = pairwise_distance_matrix(latitudes, longitudes)
+        i, j = np.nonzero(np.triu(distances <= radius, k=1))
+        return i, j, distances[i, j]
+
+    # equirectangular projection (km) scaled with the smallest cos(latitude) of the fleet: projected
+    # distances are never longer than the real ones, so no close pair is missed (1% of margin for
+    # the approximation), the haversine distance then filters the candidate pairs
+    min_cos = np.cos(np.radians(np.abs(latitudes).max()))
+    points = np.column_stack((
+        EARTH_RADIUS_KM * np.radians(longitudes) * min_cos,
+        EARTH_RADIUS_KM * np.radians(latitudes)
+    ))
+    pairs = cKDTree(points).query_pairs(radius * 1.01, output_type='ndarray')
+    if len(pairs) == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0)
+    i, j = pairs[:, 0], pairs[:, 1]
+    distances = haversine_distance(latitudes[i], longitudes[i], latitudes[j], longitudes[j])
+    close = distances <= radius
+    return i[close], j[close], distances[close]
@@ -1,17 +1,29 @@
 import paho.mqtt.client as paho
-from prometheus_client import Gauge, Enum, CollectorRegistry, push_to_gateway
+from prometheus_client import Gauge, Counter, Histogram, Enum, CollectorRegistry
 from scipy.interpolate import CubicSpline
-from shapely.geometry import Point, Polygon
+from shapely.geometry import Polygon
+import atexit
 import json
-import urllib.request
-import urllib.parse
 import time
 import threading
-import math
 import numpy as np
 import matplotlib.pyplot as plt
-import requests
-import re
+
+from track_store import TrackStore, TrackSnapshot, LastFixCache
+from zones import ZoneRegistry
+from spatial_grid import SpatialGrid
+from pipeline import IngestPipeline, MicroBatcher
+from publisher import MetricsPublisher
+from http_client import HttpClient
+from geodesy import haversine_distance, haversine_distance_in_meters, perpendicular_points, destination_point
+from close_approach import close_pairs
+from cpa import track_velocities, fleet_cpa_rows
+from motion_filter import FilterBank
+from sharding import ShardCoordinator, ShardLink
+from fleet_snapshot import SharedFleetSnapshot, FleetSnapshotWriter
+from instrumentation import StageTimer, StackSampler
+from wal import WriteAheadLog
+from track_archive import TrackArchive
 
 DEBUG = False
 
@@ -45,10 +57,154 @@ DISTANCE_METRIC = Gauge('distance', 'Distance from sensor', ['device_id'], regis
 DATE_METRIC = Gauge('date', 'Date from sensor', ['device_id'], registry=registry)
 COLLISON_DETECTION_METRIC = Gauge('collison_detection', 'Collison detection from sensor', ['device_id'], registry=registry)
 
-
-# Function to round coordinates to 7 decimal places
-def round_coordinates(coordinates, precision=7):
-    return [[round(coord[0], precision), round(coord[1], precision)] for coord in coordinates]
+# Shared HTTP client (connection pooling, timeouts and retries) for Prometheus, Pushgateway and nginx
+HTTP_RETRIES = 2
+HTTP_TIMEOUTS = {
+    'prometheus': (2, 5),
+    'pushgateway': (2, 5),
+    'nginx': (2, 10),
+}
+HTTP_LATENCY_METRIC = Histogram('http_request_duration_seconds', 'Duration of the HTTP requests of the consumer', ['target'], registry=registry)
+HTTP_CLIENT = HttpClient(HTTP_TIMEOUTS, HTTP_RETRIES, latency_metric=HTTP_LATENCY_METRIC)
+
+# In-memory history of the fleet, used by collision and state checks instead of Prometheus range queries
+TRACK_WINDOW_SECONDS = 120
+TRACK_MAX_POINTS = 32
+TRACK_MAX_DEVICES = 1000
+TRACK_STORE_WARM_START = True
+TRACK_STORE = TrackStore(TRACK_WINDOW_SECONDS, TRACK_MAX_POINTS, TRACK_MAX_DEVICES)
+
+# Last fix of each device, used to calculate distance and speed (Prometheus is only a cold start fallback)
+LAST_FIX_CACHE = LastFixCache(TRACK_MAX_DEVICES)
+LAST_FIX_CACHE_METRIC = Counter('last_fix_cache', 'Lookups of the previous fix of a device in the local cache', ['result'], registry=registry)
+
+# Prediction of the next positions, moving / standby classification and error corridor width:
+# 'spline' (cubic spline fitted on the track at each prediction) or 'kalman' (filter of each device updated with each fix)
+PREDICTION_METHOD = 'spline'
+# Predicted positions of the error zones (one every 20 seconds)
+PREDICTION_STEPS = 3
+# Kalman filter: standard deviation of the GPS positions (m) and of the accelerations of the boats (m/s²)
+KALMAN_MEASUREMENT_NOISE = 10
+KALMAN_PROCESS_NOISE = 0.1
+# A boat is moving above KALMAN_MOVING_SPEED (m/s), the error corridor is KALMAN_CORRIDOR_SIGMAS standard deviations wide
+KALMAN_MOVING_SPEED = 0.5
+KALMAN_CORRIDOR_SIGMAS = 2
+MOTION_FILTERS = FilterBank(TRACK_MAX_DEVICES, KALMAN_MEASUREMENT_NOISE, KALMAN_PROCESS_NOISE)
+
+# Write-ahead log of the decoded uplinks on the /app volume: at startup the track store, the last fixes and the Kalman
+# filters are rebuilt from it (Prometheus is only queried if it is empty). Compacted every WAL_COMPACT_INTERVAL seconds
+WAL_ENABLED = True
+WAL_PATH = '/app/wal/uplinks.wal'
+WAL_COMPACT_INTERVAL = 300
+WAL = WriteAheadLog(WAL_PATH, TRACK_WINDOW_SECONDS, WAL_COMPACT_INTERVAL) if WAL_ENABLED else None
+
+# Long-term history of the fleet: columnar segments (one .npy file by column) by day and device in ARCHIVE_DIR,
+# for voyage replays and analytics without Prometheus (see TrackArchive.track)
+ARCHIVE_ENABLED = True
+ARCHIVE_DIR = '/app/archive'
+ARCHIVE_FLUSH_INTERVAL = 10
+TRACK_ARCHIVE = TrackArchive(ARCHIVE_DIR, ARCHIVE_FLUSH_INTERVAL) if ARCHIVE_ENABLED else None
+
+# Zones (geojson files on nginx) kept in memory, refreshed in background every ZONE_REFRESH_INTERVAL seconds
+ZONE_REFRESH_INTERVAL = 60
+ZONE_VERSION_METRIC = Gauge('zone_registry_version', 'Version of the zones loaded from nginx', registry=registry)
+ZONE_RELOAD_METRIC = Gauge('zone_registry_reload_timestamp', 'Date of the last reload of the zones', registry=registry)
+ZONE_COUNT_METRIC = Gauge('zone_registry_zones', 'Number of zones loaded from nginx', registry=registry)
+
+def on_zones_reload(zone_registry):
+    ZONE_VERSION_METRIC.set(zone_registry.version)
+    ZONE_RELOAD_METRIC.set(zone_registry.loaded_at)
+    ZONE_COUNT_METRIC.set(len(zone_registry.zones))
+
+ZONE_REGISTRY = ZoneRegistry(NGINX, ZONE_REFRESH_INTERVAL, on_reload=on_zones_reload, http_client=HTTP_CLIENT)
+
+# Predictions and error zones of each device, kept until the device sends new data
+PREDICTION_CACHE = {}
+PREDICTION_CACHE_LOCK = threading.Lock()
+PREDICTION_CACHE_METRIC = Counter('prediction_cache', 'Lookups of the predicted error zone of a device in the local cache', ['result'], registry=registry)
+
+# Broad phase of the collision detection, size of the grid cells in degrees (0.005 ~ 550 m)
+COLLISION_GRID_CELL_SIZE = 0.005
+COLLISION_PAIRS_METRIC = Counter('collision_candidate_pairs', 'Pairs of error zones considered (broad) and tested exactly (narrow) by the collision detection', ['phase'], registry=registry)
+
+# Collision detection method: 'corridor' (predicted error zones intersection) or 'cpa' (closest point of approach)
+COLLISION_METHOD = 'corridor'
+# With 'cpa', a collision is detected if 2 boats come closer than CPA_DISTANCE_THRESHOLD meters within CPA_HORIZON seconds
+CPA_DISTANCE_THRESHOLD = 30
+CPA_HORIZON = 60
+CPA_DISTANCE_METRIC = Gauge('cpa_distance', 'Distance (m) at the closest point of approach with the most critical boat', ['device_id'], registry=registry)
+CPA_TIME_METRIC = Gauge('tcpa_seconds', 'Time (s) to the closest point of approach with the most critical boat', ['device_id'], registry=registry)
+# Devices having published CPA series
+CPA_LOCK = threading.Lock()
+CPA_PUBLISHED = set()
+
+# Close approach between boats (distance between their last positions), alert levels by radius in meters
+CLOSE_APPROACH_RADII = {'warning': 100, 'danger': 30}
+CLOSE_APPROACH_DISTANCE_METRIC = Gauge('close_approach_distance_meters', 'Distance between 2 boats closer than the largest close approach radius', ['device_id', 'other_device_id'], registry=registry)
+CLOSE_APPROACH_MIN_DISTANCE_METRIC = Gauge('close_approach_min_distance_meters', 'Distance to the nearest boat, if closer than the largest close approach radius', ['device_id'], registry=registry)
+CLOSE_APPROACH_ALERT_METRIC = Gauge('close_approach_alert', 'Close approach level of the boat (0: none, 1: warning, 2: danger)', ['device_id'], registry=registry)
+# Each uplink only checks its device against the fleet, the whole fleet is checked every CLOSE_APPROACH_FULL_INTERVAL seconds
+# (and by each micro-batch)
+CLOSE_APPROACH_FULL_INTERVAL = 30
+CLOSE_APPROACH_LOCK = threading.Lock()
+# Close pairs (device_id, other_device_id) -> distance in meters, close boats of each device, published series
+# (pairs, nearest boat distances and alert levels)
+CLOSE_APPROACH_PAIRS = {}
+CLOSE_APPROACH_NEIGHBOURS = {}
+CLOSE_APPROACH_PUBLISHED = {'pairs': set(), 'devices': set(), 'alerts': set(), 'last_full_check': 0.0}
+
+# Queue between the MQTT callback and the workers processing the messages (policy: 'block', 'drop_newest' or 'drop_oldest')
+INGEST_WORKERS = 4
+INGEST_QUEUE_SIZE = 1000
+INGEST_QUEUE_POLICY = 'drop_oldest'
+INGEST_LATENCY_METRIC = Histogram('ingest_latency_seconds', 'Time spent by a message waiting in the queue (wait) and being processed (process)', ['stage'], registry=registry)
+INGEST_DROPPED_METRIC = Counter('ingest_dropped', 'Messages dropped because the ingest queue was full', registry=registry)
+INGEST_QUEUE_DEPTH_METRIC = Gauge('ingest_queue_depth', 'Messages waiting in the ingest queue', registry=registry)
+# Processing of the messages: one by one by the workers ('message'), or in micro-batches ('batch') of the messages received
+# during INGEST_BATCH_WINDOW seconds, with a single snapshot, collision pass and push for the whole batch
+INGEST_MODE = 'message'
+INGEST_BATCH_WINDOW = 0.25
+INGEST_BATCH_MAX_SIZE = 1000
+INGEST_BATCH_SIZE_METRIC = Histogram('ingest_batch_size', 'Messages processed together in a micro-batch', buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000), registry=registry)
+INGEST_BATCH_LATENCY_METRIC = Histogram('ingest_batch_latency_seconds', 'Time from the reception of a message to the end of the processing of its micro-batch', registry=registry)
+
+# Timing of the stages of the processing of the messages (histograms, in-flight and error counters), free when disabled
+STAGE_METRICS_ENABLED = True
+# Sampling profiler: the stacks of the stages slower than PROFILE_THRESHOLD seconds are written in PROFILE_DIR
+# (collapsed stacks for flame graphs), None to disable
+PROFILE_THRESHOLD = None
+PROFILE_INTERVAL = 0.005
+PROFILE_DIR = '/app/profiles'
+STACK_SAMPLER = StackSampler(PROFILE_THRESHOLD, PROFILE_INTERVAL, PROFILE_DIR) if PROFILE_THRESHOLD is not None else None
+STAGE_TIMER = StageTimer(registry, STAGE_METRICS_ENABLED, STACK_SAMPLER)
+
+# Publication of the metrics: 'push' to the Pushgateway every METRICS_PUSH_INTERVAL seconds (or METRICS_PUSH_MAX_PENDING updates),
+# or 'scrape' to expose them on METRICS_PORT for Prometheus (see prometheus.yml)
+METRICS_MODE = 'push'
+METRICS_PUSH_INTERVAL = 5
+METRICS_PUSH_MAX_PENDING = 200
+METRICS_PORT = 8000
+METRICS_PUBLISHER = MetricsPublisher(registry, PUSHGATEWAY, 'data-ship', METRICS_MODE, METRICS_PUSH_INTERVAL, METRICS_PUSH_MAX_PENDING, METRICS_PORT, HTTP_CLIENT, timer=STAGE_TIMER.timed('push'))
+
+# Sharded mode: with SHARDS > 1, the devices are partitioned (hash of the device name) between SHARDS worker
+# processes, the main process only dispatches the messages. The fixes of each shard are forwarded to the others for the
+# collision checks. Each shard pushes its metrics with a 'shard' grouping key (or exposes them on METRICS_PORT + shard)
+SHARDS = 1
+SHARD_QUEUE_SIZE = 1000
+SHARD_DROPPED_METRIC = Counter('shard_dropped', 'Messages dropped because the queue of a shard was full', registry=registry)
+# Fixes waiting to be forwarded between the shards (by queue), dropped beyond when a shard stalls
+SHARD_FIXES_QUEUE_SIZE = 10000
+SHARD_DROPPED_FIXES_METRIC = Counter('shard_dropped_fixes', 'Fixes not forwarded between the shards because a queue was full', registry=registry)
+# Fleet view of the shards: 'shared_memory' (last fix, velocity and predicted error zone of every device in a snapshot
+# shared by the shards, see fleet_snapshot.py: each shard only predicts its own devices) or 'coordinator' (the fixes are
+# forwarded by the main process to every shard, which predicts the whole fleet: the prediction work grows with SHARDS,
+# only to check the shared memory view against full tracks)
+SHARD_FLEET_VIEW = 'shared_memory'
+# ShardLink of the worker process (None when not sharded) and ShardCoordinator of the main process
+SHARD_LINK = None
+SHARD_COORDINATOR = None
+# FleetSnapshotWriter of the worker process ('shared_memory' fleet view only)
+FLEET_SNAPSHOT_WRITER = None
 
 
 #############################################################################################
@@ -56,95 +212,62 @@ def round_coordinates(coordinates, precision=7):
 #############################################################################################
 
 '''
-Get all zones (list of points which define a polygon zone)
+Checking if coordinate are in areas
 '''
-def get_zones_checking():
-    pattern = re.compile(r".+\.geojson", re.IGNORECASE)
-    try:
-        res = requests.get(NGINX + '/list_files/')
-        res.raise_for_status()
-        list_files = res.json()
-        print(list_files)
-        data = []
-        for file in list_files:
-            if file["type"] != "file":
-                continue
-            if pattern.match(file["name"]) == None:
-                continue
-            res = requests.get(NGINX + '/data/' + file["name"])
-            res.raise_for_status()
-            data.append(res.json())
-
-        return data
-    except Exception as e:
-        print(f"Failed to fetch data from NGINX: {e}")
-        return {}
+def check_position_area(lat, lon):
+    return 1 if ZONE_REGISTRY.contains(lat, lon) else 3
 
 '''
-Build a list of Polygon (object)
-'''
-def merge_zones_checking():
-    polygons_list = []
-
-    datas = get_zones_checking()
-    for data in datas:
-        features = data["features"]
-        for feature in features:
-            if feature['geometry']['type'] != 'Polygon':
-                continue
-            #only process first zone
-            polygon_coordinates = feature['geometry']['coordinates'][0]
-            rounded_polygon_coordinates = round_coordinates(polygon_coordinates)
-            polygon = Polygon(rounded_polygon_coordinates)
-            polygons_list.append(polygon)
-    
-    return polygons_list
+Checking if many coordinates are in areas at once (arrays of latitudes and longitudes)
 
+Return an array of states (1 = MOVING, 3 = OUT OF RANGE)
 '''
-Checking if coordinate are in areas
-'''
-def check_position_area(lat, lon):
-    # Create a Point and Polygon object
-    point = Point(lon, lat)  # Note: Point takes (x, y) which corresponds to (lon, lat)
-    polygons = merge_zones_checking()
-    for polygon in polygons:
-        if polygon.contains(point) or polygon.within(point):
-            return 1
-    return 3
+def check_position_area_batch(latitudes, longitudes):
+    inside = ZONE_REGISTRY.index.contains_batch(latitudes, longitudes)
+    return np.where(inside, 1, 3).astype(np.int8)
 
 '''
 return current state of the device 'current_device_data'
 '''
+@STAGE_TIMER.timed('state')
 def check_state(current_device_data, data):
-    if len(data) == 0:
+    if data is None or len(data) == 0:
         return 2
-    return 2 if not(is_moving_noise_reduction(current_device_data, data)) else check_position_area(current_device_data['latitude'], current_device_data['longitude'])
+    if PREDICTION_METHOD == 'kalman':
+        moving = is_moving_kalman(current_device_data['device_id'])
+    else:
+        moving = is_moving_noise_reduction(current_device_data, data)
+    return 2 if not(moving) else check_position_area(current_device_data['latitude'], current_device_data['longitude'])
 
 '''
 To define if the boat is moving or not, by reducing the noice of GPS data
 '''
 def is_moving_noise_reduction(current, data, threshold_avg = 15, threshold_far=35, num_points=5):
-    data = list(data.values())
     if len(data) == 0:
         return False
 
     lon_current = current["longitude"]
     lat_current = current["latitude"]
 
-    total_distance = 0
-    farest_point = 0
-    if(len(data) == 0):
+    # previous fixes, most recent first (the last fix of the track is the current one)
+    lon_prev = data.longitude[-2::-1][:num_points]
+    lat_prev = data.latitude[-2::-1][:num_points]
+    if len(lat_prev) == 0:
         return False
-    for i in range(0, min(num_points, len(data))):
-        lon_prev = data[i]["longitude"]
-        lat_prev = data[i]["latitude"]
-        distance = haversine_distance_in_meters(lon_current, lat_current, lon_prev, lat_prev)
-        if distance > farest_point:
-            farest_point = distance
-        total_distance += distance
-    average_distance = total_distance / num_points
+    distances = haversine_distance_in_meters(lat_current, lon_current, lat_prev, lon_prev)
+    farest_point = distances.max()
+    average_distance = distances.sum() / num_points
     return True if farest_point > threshold_far else False if average_distance < threshold_avg else True
 
+'''
+To define if the boat is moving or not, from the speed estimated by its Kalman filter
+'''
+def is_moving_kalman(device_id):
+    motion_filter = MOTION_FILTERS.get(device_id)
+    if motion_filter is None:
+        return False
+    return motion_filter.is_moving(KALMAN_MOVING_SPEED)
+
 #############################################################################################
 #                                      FETCHING DATA                                        #
 #############################################################################################
@@ -153,9 +276,9 @@ Get the geojson file at 'url'
 '''
 def fetch_geojson_from_url(url):
     try:
-        with urllib.request.urlopen(url) as response:
-            geojson_data = json.loads(response.read().decode())
-        return geojson_data
+        res = HTTP_CLIENT.get('nginx', url)
+        res.raise_for_status()
+        return res.json()
     except Exception as e:
         print(f"Failed to fetch GeoJSON data from URL {url}: {e}")
         return None
@@ -165,282 +288,668 @@ Request on Prometheus to get previous data
 '''
 def fetch_prometheus_data(query):
     try:
-        encoded_query = urllib.parse.quote(query)
-        url = PROMETHEUS + '/api/v1/query?query='+ encoded_query
-        response = urllib.request.urlopen(url).read().decode()
-        return json.loads(response)['data']['result']
+        res = HTTP_CLIENT.get('prometheus', PROMETHEUS + '/api/v1/query', params={'query': query})
+        res.raise_for_status()
+        return res.json()['data']['result']
     except Exception as e:
         print(f"Failed to fetch data for query {query}: {e}")
         return []
 
 '''
-Merge differents metrics at a same date to a unique object
+Request on Prometheus the last date and position of 'device_id'
 '''
-def organize_data(data, metric_name, devices_data):
-    # print("--------")
-    # print(data)
-    # print("--------\n")
-    for entry in data:
-        metric = entry['metric']
-        device_id = metric['device_id']
-        values = entry['values']
-        if device_id not in devices_data:
-            devices_data[device_id] = {}
-
-        for value in values:
-            timestamp, val = value
-            if timestamp not in devices_data[device_id]:
-                devices_data[device_id][timestamp] = {}
-            devices_data[device_id][timestamp][metric_name] = float(val)
-    return devices_data
+def fetch_previous_values(device_id):
+    query = '{__name__=~"date|latitude|longitude",job="data-ship",device_id="' + device_id + '"}'
+    previous_data = fetch_prometheus_data(query)
+    return {item['metric']['__name__']: item['value'][1] for item in previous_data}
 
 '''
-Delete dupplicated data
+Get the previous date and position of 'device_id', from the local cache or from Prometheus on cold start
 '''
-def reduce_duplicates(data):
-    seen = set()
-    new = {}
-    for k, v in data.items():
-        if v["date"] not in seen:
-            new[k] = v
-            seen.add(v["date"])
-    del seen
-    return new
+@STAGE_TIMER.timed('previous_values')
+def get_previous_values(device_id):
+    prev_values = LAST_FIX_CACHE.get(device_id)
+    if prev_values is not None:
+        LAST_FIX_CACHE_METRIC.labels(result='hit').inc()
+        return prev_values
+    LAST_FIX_CACHE_METRIC.labels(result='miss').inc()
+    return fetch_previous_values(device_id)
+
+HISTORY_METRICS = ['date', 'latitude', 'longitude', 'speed']
 
 '''
-Build a list of data object from prometheus for each device
+Decode the result of a range query into columnar arrays per device and metric
 
-Add last data from the current device to its data
+return {device_id: {metric_name: (timestamps, values)}}
 '''
-def data_merging(last_data_device):
-    DATA_QUERY = '{job="data-ship"}[2m]'
-    device = last_data_device['device_id']
-    try:
-        date_query = 'date'+DATA_QUERY
-        latitude_query = 'latitude'+DATA_QUERY
-        longitude_query = 'longitude'+DATA_QUERY
-        speed_query = 'speed'+DATA_QUERY
+def decode_range_result(data):
+    series = {}
+    for entry in data:
+        metric = entry['metric']
+        device_id = metric.get('device_id')
+        if device_id is None or len(entry['values']) == 0:
+            continue
+        values = np.array(entry['values'], dtype=np.float64)
+        device_series = series.setdefault(device_id, {})
+        if metric['__name__'] in device_series:
+            # same metric in several series (other labels), merged by timestamp
+            previous = device_series[metric['__name__']]
+            values = np.concatenate((np.column_stack(previous), values))
+        timestamps, index = np.unique(values[:, 0], return_index=True)
+        device_series[metric['__name__']] = (timestamps, values[index, 1])
+    return series
 
-        date_data = fetch_prometheus_data(date_query)
-        latitude_data = fetch_prometheus_data(latitude_query)
-        longitude_data = fetch_prometheus_data(longitude_query)
-        speed_data = fetch_prometheus_data(speed_query)
+'''
+Build the history of each device from prometheus, over the last 'window' of time (optionally for one device only)
 
-        devices_data = {}
-        devices_data = organize_data(date_data, 'date', devices_data)
-        devices_data = organize_data(latitude_data, 'latitude', devices_data)
-        devices_data = organize_data(longitude_data, 'longitude', devices_data)
-        devices_data = organize_data(speed_data, 'speed', devices_data)
+All metrics are fetched with a single range query and joined on their sample timestamps,
+return {device_id: {'date': array, 'latitude': array, 'longitude': array, 'speed': array}} sorted by date
+'''
+def fetch_devices_history(window='2m', device_id=None):
+    selector = '__name__=~"' + '|'.join(HISTORY_METRICS) + '",job="data-ship"'
+    if device_id is not None:
+        selector += ',device_id="' + device_id + '"'
+    try:
+        series = decode_range_result(fetch_prometheus_data('{' + selector + '}[' + window + ']'))
 
-        devices_data = {device_id: reduce_duplicates(data) for device_id, data in devices_data.items()}
+        devices_data = {}
+        for device, device_series in series.items():
+            if any(name not in device_series for name in HISTORY_METRICS):
+                continue
+            # keep the samples having a value for every metric
+            timestamps = device_series[HISTORY_METRICS[0]][0]
+            for name in HISTORY_METRICS[1:]:
+                timestamps = np.intersect1d(timestamps, device_series[name][0], assume_unique=True)
+            columns = {}
+            for name in HISTORY_METRICS:
+                sample_timestamps, values = device_series[name]
+                columns[name] = values[np.searchsorted(sample_timestamps, timestamps)]
+
+            # Delete dupplicated data (the same fix is scraped several times from the Pushgateway)
+            dates, index = np.unique(columns['date'], return_index=True)
+            devices_data[device] = {name: columns[name][index] for name in HISTORY_METRICS}
 
-        for device_id, data in devices_data.items():
-            sorted_timestamps = sorted(data.keys(), reverse=True)
-            devices_data[device_id] = {ts: data[ts] for ts in sorted_timestamps}
+        return devices_data
+    except Exception as e:
+        print(f"Failed to fetch devices history: {e}")
+        return {}
 
-        if(device not in devices_data):
-            Exception(f"Device {device} not found in devices data")
+'''
+Seed the track store with the history kept by Prometheus (only once, at startup)
+'''
+def warm_track_store():
+    devices_data = fetch_devices_history(str(TRACK_WINDOW_SECONDS) + 's')
+    count = warm_from_history(devices_data)
+    print(f"Track store warmed with {count} fixes of {len(devices_data)} devices")
 
-        print(devices_data)
+'''
+Rebuild the track store, the last fixes and the Kalman filters from the write-ahead log (only once, at startup)
 
-        current_device_data = devices_data[device]
-        current_device_timestamps = sorted(current_device_data.keys(), reverse=True)
-        devices_data[device][current_device_timestamps[0]+1] = {
-            'date': last_data_device["date"],
-            'latitude': last_data_device["latitude"],
-            'longitude': last_data_device["longitude"],
-            'speed': last_data_device["speed"]
-        }
-        devices_data[device].pop(current_device_timestamps[-1])
-        current_device_latest_date = last_data_device["date"]
-        
-        return devices_data
+Return False if the log is empty
+'''
+def restore_from_wal():
+    try:
+        start = time.perf_counter()
+        devices_data, last_records = WAL.recover()
+        count = warm_from_history(devices_data)
+        # the devices silent for longer than the time window still have their previous position
+        for device_id, record in last_records.items():
+            LAST_FIX_CACHE.update(device_id, record['date'], record['latitude'], record['longitude'])
+        print(f"Track store restored from the write-ahead log in {(time.perf_counter() - start) * 1000:.1f} ms: {count} fixes of {len(last_records)} devices")
+        return len(last_records) > 0
     except Exception as e:
-        print(f"Failed to merge collision data: {e}")
-        return {}
+        print(f"Failed to restore from the write-ahead log: {e}")
+        return False
 
-#############################################################################################
-#                                   PREDICTION MOVEMENT                                     #
-#############################################################################################
+'''
+Add the history of the devices ({device_id: {'date': [...], 'latitude': [...], ...}}) to the track store,
+the Kalman filters and the last fixes, return the number of fixes added
+'''
+def warm_from_history(devices_data):
+    count = TRACK_STORE.warm(devices_data)
+    if PREDICTION_METHOD == 'kalman':
+        for device_id, data in devices_data.items():
+            for i in np.argsort(data['date']):
+                MOTION_FILTERS.update(device_id, data['date'][i], data['latitude'][i], data['longitude'][i])
+    for device_id in devices_data:
+        fix = TRACK_STORE.last_fix(device_id)
+        if fix is not None:
+            LAST_FIX_CACHE.update(device_id, fix['date'], fix['latitude'], fix['longitude'])
+    return count
 
 '''
-Calculate distance from 2 points in meters
+Add last data from the current device to the track store (and to its Kalman filter)
 '''
-def haversine_distance_in_meters(lat1, lon1, lat2, lon2):
-    return haversine_distance(lat1, lon1, lat2, lon2) * 1000
+def store_fix(last_data_device):
+    fix = (last_data_device['device_id'], last_data_device['date'], last_data_device['latitude'], last_data_device['longitude'], last_data_device['speed'])
+    added = apply_fix(*fix)
+    if added:
+        log_uplink(last_data_device)
+    # the other shards need the fix for their collision checks
+    if added and SHARD_LINK is not None:
+        SHARD_LINK.publish(fix)
+    return added
 
 '''
-Calculate distance from 2 points in kilometers
+Append a decoded uplink to the write-ahead log and to the track archive (the sensor values are optional)
 '''
-def haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371.0  # Earth radius
-    dlat = np.radians(lat2 - lat1)
-    dlon = np.radians(lon2 - lon1)
-    a = np.sin(dlat / 2)**2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon / 2)**2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-    return R * c
+def log_uplink(last_data_device):
+    record = (
+        last_data_device['device_id'], last_data_device['date'], last_data_device['latitude'], last_data_device['longitude'], last_data_device['speed'],
+        last_data_device.get('acceleration_x', np.nan), last_data_device.get('acceleration_y', np.nan), last_data_device.get('acceleration_z', np.nan),
+        last_data_device.get('battery', np.nan), last_data_device.get('temperature', np.nan)
+    )
+    try:
+        if WAL is not None:
+            WAL.append(*record)
+        if TRACK_ARCHIVE is not None:
+            TRACK_ARCHIVE.append(*record)
+    except Exception as e:
+        print(f"Failed to log uplink: {e}")
 
 '''
-Calculate point from an point, a distance, an angle$
+Add a fix to the track store and to the Kalman filter of the device (fixes from the other shards come directly here)
+'''
+def apply_fix(device_id, date, latitude, longitude, speed):
+    added = TRACK_STORE.add_fix(device_id, date, latitude, longitude, speed)
+    if added and PREDICTION_METHOD == 'kalman':
+        MOTION_FILTERS.update(device_id, date, latitude, longitude)
+    return added
 
-Used to calculate the collision zone
 '''
-def move_point(lat, lon, distance, bearing):
-    R = 6371.0  # Earth radius
-    lat = np.radians(lat)
-    lon = np.radians(lon)
-    lat2 = np.arcsin(np.sin(lat) * np.cos(distance / R) + np.cos(lat) * np.sin(distance / R) * np.cos(bearing))
-    lon2 = lon + np.arctan2(np.sin(bearing) * np.sin(distance / R) * np.cos(lat), np.cos(distance / R) - np.sin(lat) * np.sin(lat2))
-    return np.degrees(lat2), np.degrees(lon2)
+Return True if the metrics of the device are published by this process (always, unless sharded)
+'''
+def owns_device(device_id):
+    return SHARD_LINK is None or SHARD_LINK.owns(device_id)
 
 '''
-calculate 2 points which are perpendicular to the 2 points in params
+Add last data from the current device to the track store
+
+Return the recent data of each device (time window ending at the date of the fix, its reception time)
 '''
-def calculate_perpendicular(lat1, lon1, lat2, lon2, scale_km=0.05):
-    distance = haversine_distance(lat1, lon1, lat2, lon2)
-    bearing = math.atan2(lon2 - lon1, lat2 - lat1)
+@STAGE_TIMER.timed('data_merging')
+def data_merging(last_data_device):
+    store_fix(last_data_device)
+    return fleet_view(last_data_device['date'])
 
-    # Calculer le vecteur perpendiculaire (en radians)
-    perp_bearing1 = bearing + math.pi / 2
-    perp_bearing2 = bearing - math.pi / 2
+'''
+Return the recent data of each device (track store, and the devices of the other shards in the shared fleet snapshot)
+in the time window ending at 'now' (current time by default)
+'''
+def fleet_view(now=None):
+    devices_data = TRACK_STORE.snapshot(now)
+    if FLEET_SNAPSHOT_WRITER is not None:
+        for device_id, data in remote_fleet(now).items():
+            devices_data.setdefault(device_id, data)
+    return devices_data
 
-    # Calculer les points de la perpendiculaire
-    perp_point1 = move_point(lat2, lon2, scale_km, perp_bearing1)
-    perp_point2 = move_point(lat2, lon2, scale_km, perp_bearing2)
+'''
+Devices of the other shards, from the shared fleet snapshot
 
-    return perp_point1, perp_point2
+Each device is seen as a track of 2 fixes (its last fix, and its position 1 s before from its velocity),
+and its predicted error zone goes to the prediction cache: the collision checks use them like local devices
+'''
+def remote_fleet(now=None):
+    now = time.time() if now is None else now
+    records = FLEET_SNAPSHOT_WRITER.snapshot.read()
+    records = records[records['date'] >= now - TRACK_WINDOW_SECONDS]
+
+    devices_data = {}
+    for record in records:
+        device_id = record['device_id'].decode()
+        if device_id in FLEET_SNAPSHOT_WRITER:
+            continue
+        date, latitude, longitude = float(record['date']), float(record['latitude']), float(record['longitude'])
+        speed = np.hypot(record['v_east'], record['v_north'])
+        prev_latitude, prev_longitude = destination_point(latitude, longitude, speed / 1000, np.arctan2(record['v_east'], record['v_north']) + np.pi)
+        devices_data[device_id] = TrackSnapshot(np.array([
+            [date - 1, date],
+            [prev_latitude, latitude],
+            [prev_longitude, longitude],
+            [record['speed'], record['speed']]
+        ]))
+
+        with PREDICTION_CACHE_LOCK:
+            cached = PREDICTION_CACHE.get(device_id)
+        if cached is None or cached['date'] != date:
+            ring = record['zone'][~np.isnan(record['zone'][:, 0])]
+            zone = Polygon(ring) if len(ring) >= 3 else None
+            with PREDICTION_CACHE_LOCK:
+                PREDICTION_CACHE[device_id] = {'date': date, 'predicted_points': {}, 'zone': zone}
+    return devices_data
 
 '''
-predict next position from current and last GPS data
+Write the last fix, velocity and predicted error zone of a device of this shard in the shared fleet snapshot
+'''
+def publish_fleet_record(device_id, devices_data):
+    data = devices_data.get(device_id)
+    if FLEET_SNAPSHOT_WRITER is None or data is None:
+        return
+    zone = get_error_zone(device_id, data)
+    if PREDICTION_METHOD == 'kalman':
+        v_east, v_north = kalman_velocities([device_id], [data])
+    else:
+        v_east, v_north = track_velocities([data])
+    ring = None if zone is None else np.asarray(zone.exterior.coords)[:-1]
+    last = data.last()
+    try:
+        if not FLEET_SNAPSHOT_WRITER.publish(device_id, last['date'], last['latitude'], last['longitude'], last['speed'], v_east[0], v_north[0], ring):
+            print(f"Failed to publish {device_id} in the fleet snapshot: no free slot")
+    except ValueError as e:
+        print(f"Failed to publish {device_id} in the fleet snapshot: {e}")
+
+#############################################################################################
+#                                   PREDICTION MOVEMENT                                     #
+#############################################################################################
 
-return a list of predected position
+'''
+predict next position from current and last GPS data (TrackSnapshot of the device)
+
+return the predicted positions and their perpendicular points as arrays (one value by step)
 '''
 def predict_next_points(gps_data, num_predictions=3, time_step=20, base_error_step=0.02):
 
     try:
-        seen = set()
-        # delete entries that have same values in gps_data
-        new = {}
-        for k, v in gps_data.items():
-            if v["date"] not in seen:
-                new[k] = v
-                seen.add(v["date"])
-        del seen
-
-        gps_data = new
-        del new
-
-        if(gps_data.__len__() < 2):
+        # the track is sorted by date without duplicates (see TrackStore)
+        latitudes = gps_data.latitude
+        longitudes = gps_data.longitude
+        times = gps_data.date
+        speeds = gps_data.speed
+
+        if(len(times) < 2):
             return {}
 
-        timestamps = sorted(gps_data.keys())
-        last_point = gps_data[timestamps[-1]]
-        
-        # Extract latitudes, longitudes, times, and speeds
-        latitudes = [gps_data[ts]['latitude'] for ts in timestamps]
-        longitudes = [gps_data[ts]['longitude'] for ts in timestamps]
-        times = [gps_data[ts]['date'] for ts in timestamps]
-        speeds = [gps_data[ts]['speed'] for ts in timestamps]
-        
         # Create a cubic spline interpolation of latitude and longitude over time
         cs_lat = CubicSpline(times, latitudes)
         cs_lon = CubicSpline(times, longitudes)
-        
-        predicted_points = {}
-        last_time = times[-1]
-        current_time = last_time
-        
-        for i in range(1, num_predictions + 1):
-            prev_lat = latitudes[-1] if i == 1 else predicted_points[last_time + i - 1]['latitude']
-            prev_long = longitudes[-1] if i == 1 else predicted_points[last_time + i - 1]['longitude']
-            
-            current_time += time_step
-            next_lat = cs_lat(current_time)
-            next_lon = cs_lon(current_time)
-            
-            # Estimate the date for the next point
-            next_date = current_time
-            
-            # Calculate error margin distance (inverse of speed)
-            current_speed = speeds[-1] if i == 1 else speeds[-1]  # Use the last known speed (or can use average speed)
-            # error_margin = base_error_step
-            error_margin = base_error_step * (time_step / 5) / current_speed * i if current_speed != 0 else 0.000001
-            
-            # Calculate perpendicular points
-            perp_point1, perp_point2 = calculate_perpendicular(prev_lat, prev_long, next_lat, next_lon, error_margin)
-            
-            predicted_points[last_time + i] = {
-                'date': next_date,
-                'latitude': next_lat,
-                'longitude': next_lon,
-                'perp_point1': {'latitude': perp_point1[0], 'longitude': perp_point1[1]},
-                'perp_point2': {'latitude': perp_point2[0], 'longitude': perp_point2[1]},
-                'vitesse': None,  # Speed not calculated in this approach
-                'distance': None  # Distance not calculated in this approach
-            }
-        
-        return predicted_points
+
+        # Evaluate the whole horizon at once
+        steps = np.arange(1, num_predictions + 1)
+        next_dates = times[-1] + steps * time_step
+        next_lats = cs_lat(next_dates)
+        next_lons = cs_lon(next_dates)
+
+        # Each predicted point starts from the previous one (the last known point for the first step)
+        prev_lats = np.concatenate(([latitudes[-1]], next_lats[:-1]))
+        prev_lons = np.concatenate(([longitudes[-1]], next_lons[:-1]))
+
+        # Calculate error margin distance (inverse of the last known speed)
+        current_speed = speeds[-1]
+        if current_speed != 0:
+            error_margins = base_error_step * (time_step / 5) / current_speed * steps
+        else:
+            error_margins = np.full(num_predictions, 0.000001)
+
+        # Calculate perpendicular points
+        perp_point1, perp_point2 = perpendicular_points(prev_lats, prev_lons, next_lats, next_lons, error_margins)
+
+        return {
+            'date': next_dates,
+            'latitude': next_lats,
+            'longitude': next_lons,
+            'perp_point1': {'latitude': perp_point1[0], 'longitude': perp_point1[1]},
+            'perp_point2': {'latitude': perp_point2[0], 'longitude': perp_point2[1]}
+        }
     except Exception as e:
         print(f"Failed to predict next points: {e}")
         return {}
 
 '''
-Recurring function to build a zone with the predicted points  
+predict next positions of a device from its Kalman filter (same result as predict_next_points)
+
+The error margin on each side is KALMAN_CORRIDOR_SIGMAS standard deviations of the predicted position
 '''
-def create_error_zone_recurence(polygon, predicted_points):
-    if predicted_points == {}:
-        return polygon
-    ts, point = predicted_points.popitem()
-    polygon.append((point['perp_point1']['longitude'], point['perp_point1']['latitude']))
-    polygon = create_error_zone_recurence(polygon, predicted_points)
-    polygon.append((point['perp_point2']['longitude'], point['perp_point2']['latitude']))
+def predict_next_points_kalman(device_id, gps_data, num_predictions=3, time_step=20):
+    try:
+        motion_filter = MOTION_FILTERS.get(device_id)
+        if motion_filter is None or motion_filter.updates < 2:
+            return {}
+
+        steps = np.arange(1, num_predictions + 1)
+        next_dates = gps_data.date[-1] + steps * time_step
+        next_lats, next_lons, deviations = motion_filter.predict(next_dates)
 
-    return polygon
+        # Each predicted point starts from the previous one (the last known point for the first step)
+        prev_lats = np.concatenate(([gps_data.latitude[-1]], next_lats[:-1]))
+        prev_lons = np.concatenate(([gps_data.longitude[-1]], next_lons[:-1]))
+        error_margins = KALMAN_CORRIDOR_SIGMAS * deviations / 1000
 
+        perp_point1, perp_point2 = perpendicular_points(prev_lats, prev_lons, next_lats, next_lons, error_margins)
+
+        return {
+            'date': next_dates,
+            'latitude': next_lats,
+            'longitude': next_lons,
+            'perp_point1': {'latitude': perp_point1[0], 'longitude': perp_point1[1]},
+            'perp_point2': {'latitude': perp_point2[0], 'longitude': perp_point2[1]}
+        }
+    except Exception as e:
+        print(f"Failed to predict next points: {e}")
+        return {}
 
 '''
 Return a possible travel area (Polygon)
+
+The ring goes from the last known point along the first side of the predicted points, and back along the other side
 '''
 def create_error_zone_polygon(gps_data, predicted_points):
-    timestamps = sorted(gps_data.keys())
-    last_point = gps_data[timestamps[-1]]
-    last_lat = last_point['latitude']
-    last_lon = last_point['longitude']
-    
-    predicted_points = dict(reversed(sorted(predicted_points.items())))
-
-    points = [(last_lon, last_lat)]
-    points = create_error_zone_recurence(points, predicted_points)
-    
+    last_point = gps_data.last()
+
+    side1 = np.column_stack((predicted_points['perp_point1']['longitude'], predicted_points['perp_point1']['latitude']))
+    side2 = np.column_stack((predicted_points['perp_point2']['longitude'], predicted_points['perp_point2']['latitude']))
+    points = np.concatenate(([[last_point['longitude'], last_point['latitude']]], side1, side2[::-1]))
+
     return Polygon(points)
 
+'''
+Return the possible travel area (Polygon) of a device, or None if it can not be predicted
+
+The prediction is cached per device and only computed again when the device sends new data
+'''
+def get_error_zone(device_id, data):
+    if len(data) == 0:
+        return None
+    latest_date = data.date[-1]
+    with PREDICTION_CACHE_LOCK:
+        cached = PREDICTION_CACHE.get(device_id)
+    if cached is not None and cached['date'] == latest_date:
+        PREDICTION_CACHE_METRIC.labels(result='hit').inc()
+        return cached['zone']
+    PREDICTION_CACHE_METRIC.labels(result='miss').inc()
+
+    error_zone_polygon = None
+    if PREDICTION_METHOD == 'kalman':
+        predicted_points = predict_next_points_kalman(device_id, data, PREDICTION_STEPS)
+    else:
+        predicted_points = predict_next_points(data, PREDICTION_STEPS)
+    if predicted_points != {}:
+        error_zone_polygon = create_error_zone_polygon(data, predicted_points)
+        if error_zone_polygon.is_empty:
+            error_zone_polygon = None
+
+    with PREDICTION_CACHE_LOCK:
+        PREDICTION_CACHE[device_id] = {'date': latest_date, 'predicted_points': predicted_points, 'zone': error_zone_polygon}
+    return error_zone_polygon
+
+'''
+Forget the predictions of the devices which are not in 'device_ids' anymore
+'''
+def purge_prediction_cache(device_ids):
+    with PREDICTION_CACHE_LOCK:
+        for device_id in [device_id for device_id in PREDICTION_CACHE if device_id not in device_ids]:
+            del PREDICTION_CACHE[device_id]
+
 '''
 Check if current device have any collision route with other devices 
 '''
+@STAGE_TIMER.timed('collision')
 def check_collision(current_device_id, devices_data):
-    devices_data = devices_data
-    current_zone = {}
-    zones = []
+    current_zone = None
+    zones = {}
+    grid = SpatialGrid(COLLISION_GRID_CELL_SIZE)
 
+    seen = set()
     for device_id, data in devices_data:
-        predicted_points = predict_next_points(data)
-        if predicted_points == {}:
-            break
-        # get first data of the device
-        error_zone_polygon = create_error_zone_polygon(data, predicted_points)
+        seen.add(device_id)
+        error_zone_polygon = get_error_zone(device_id, data)
+        if error_zone_polygon is None:
+            continue
         if(device_id == current_device_id):
             current_zone = error_zone_polygon
         else:
-            zones.append(error_zone_polygon)
+            zones[device_id] = error_zone_polygon
+            grid.insert(device_id, error_zone_polygon.bounds)
 
-    for zone in zones:
-        if zone.intersects(current_zone):
+    purge_prediction_cache(seen)
+
+    if current_zone is None:
+        return 0
+
+    # broad phase: only the zones sharing a cell of the grid with the current zone reach the exact intersection
+    candidates = grid.query(current_zone.bounds)
+    COLLISION_PAIRS_METRIC.labels(phase='broad').inc(len(zones))
+    COLLISION_PAIRS_METRIC.labels(phase='narrow').inc(len(candidates))
+
+    for device_id in candidates:
+        if zones[device_id].intersects(current_zone):
             # DEBUG
-            # plot_trajectories(current_zone, zones)
+            # plot_trajectories(current_zone, list(zones.values()))
             return 1
 
     return 0
 
+'''
+Check the collision routes of the whole fleet in one pass (error zones of all devices)
+
+Return the set of the devices having a collision route with another device
+'''
+@STAGE_TIMER.timed('collision')
+def check_collisions_fleet(devices_data):
+    zones = {}
+    grid = SpatialGrid(COLLISION_GRID_CELL_SIZE)
+    for device_id, data in devices_data.items():
+        error_zone_polygon = get_error_zone(device_id, data)
+        if error_zone_polygon is not None:
+            zones[device_id] = error_zone_polygon
+            grid.insert(device_id, error_zone_polygon.bounds)
+
+    purge_prediction_cache(set(devices_data.keys()))
+
+    candidates = grid.candidate_pairs()
+    COLLISION_PAIRS_METRIC.labels(phase='broad').inc(len(zones) * (len(zones) - 1) // 2)
+    COLLISION_PAIRS_METRIC.labels(phase='narrow').inc(len(candidates))
+
+    colliding = set()
+    for device_a, device_b in candidates:
+        if zones[device_a].intersects(zones[device_b]):
+            colliding.update((device_a, device_b))
+    return colliding
+
+'''
+Check if current device comes too close to another device, with the closest point of approach (CPA)
+
+The velocities come from the last fixes of the track store, the positions of all boats are moved to the
+date of the fix of the current device and the CPA is computed for all pairs with the current device at once.
+Publish the distance and time of the closest approach within CPA_HORIZON (from the date of the fix)
+'''
+def check_collision_cpa(current_device_id, devices_data):
+    if current_device_id not in devices_data or len(devices_data) < 2:
+        return 0
+    return 1 if current_device_id in check_collisions_cpa([current_device_id], devices_data) else 0
+
+'''
+Closest point of approach of several devices ('checked_ids', e.g. the devices of a micro-batch) with the fleet
+
+The positions and velocities of the fleet are computed once, and the CPA of all the checked devices in one
+vectorized call. Publish the CPA metrics of each checked device (the series of the boats which left the fleet
+are removed), return the set of the colliding ones
+'''
+@STAGE_TIMER.timed('collision')
+def check_collisions_cpa(checked_ids, devices_data):
+    with CPA_LOCK:
+        # the boats which left the time window are not published anymore
+        for device_id in CPA_PUBLISHED - devices_data.keys():
+            CPA_DISTANCE_METRIC.remove(device_id)
+            CPA_TIME_METRIC.remove(device_id)
+            CPA_PUBLISHED.discard(device_id)
+
+    device_ids = list(devices_data.keys())
+    positions = {device_id: index for index, device_id in enumerate(device_ids)}
+    checked_ids = [device_id for device_id in checked_ids if device_id in positions]
+    if len(checked_ids) == 0 or len(device_ids) < 2:
+        return set()
+    tracks = [devices_data[device_id] for device_id in device_ids]
+    latitudes = np.array([track.latitude[-1] for track in tracks])
+    longitudes = np.array([track.longitude[-1] for track in tracks])
+    dates = np.array([track.date[-1] for track in tracks])
+    if PREDICTION_METHOD == 'kalman':
+        v_east, v_north = kalman_velocities(device_ids, tracks)
+    else:
+        v_east, v_north = track_velocities(tracks)
+
+    indexes = [positions[device_id] for device_id in checked_ids]
+    distances, times = fleet_cpa_rows(indexes, latitudes, longitudes, v_east, v_north, CPA_HORIZON, dates)
+    critical = np.argmin(distances, axis=1)
+    rows = np.arange(len(indexes))
+    critical_distances = distances[rows, critical]
+    critical_times = times[rows, critical]
+
+    colliding = set()
+    with CPA_LOCK:
+        for device_id, distance, seconds in zip(checked_ids, critical_distances.tolist(), critical_times.tolist()):
+            CPA_DISTANCE_METRIC.labels(device_id=device_id).set(distance)
+            CPA_TIME_METRIC.labels(device_id=device_id).set(seconds)
+            CPA_PUBLISHED.add(device_id)
+            if distance <= CPA_DISTANCE_THRESHOLD:
+                colliding.add(device_id)
+    return colliding
+
+'''
+Velocities (v_east, v_north) in m/s of the devices from their Kalman filters (from their last fixes if there is no filter)
+'''
+def kalman_velocities(device_ids, tracks):
+    v_east, v_north = track_velocities(tracks)
+    for index, device_id in enumerate(device_ids):
+        motion_filter = MOTION_FILTERS.get(device_id)
+        if motion_filter is not None:
+            v_east[index], v_north[index] = motion_filter.velocity()
+    return v_east, v_north
+
+'''
+Close approach detection over the fleet snapshot: distances between the last positions of all boats
+
+Return {device_id: (alert level, distance to the nearest boat in meters)} for the boats within a radius
+'''
+@STAGE_TIMER.timed('close_approach')
+def check_close_approach(devices_data):
+    device_ids = list(devices_data.keys())
+    latitudes = np.array([devices_data[device_id].latitude[-1] for device_id in device_ids])
+    longitudes = np.array([devices_data[device_id].longitude[-1] for device_id in device_ids])
+    radii = np.array(sorted(CLOSE_APPROACH_RADII.values(), reverse=True), dtype=np.float64) / 1000
+
+    i, j, distances = close_pairs(latitudes, longitudes, radii[0])
+    distances = distances * 1000
+    pairs = {}
+    for a, b, distance in zip(i.tolist(), j.tolist(), distances.tolist()):
+        pairs[tuple(sorted((device_ids[a], device_ids[b])))] = distance
+
+    with CLOSE_APPROACH_LOCK:
+        CLOSE_APPROACH_PUBLISHED['last_full_check'] = time.time()
+        for pair in list(CLOSE_APPROACH_PAIRS.keys() - pairs.keys()):
+            forget_close_pair(pair)
+        for pair, distance in pairs.items():
+            record_close_pair(pair, distance)
+        # the boats which left the fleet are not published anymore
+        for device_id in (CLOSE_APPROACH_PUBLISHED['devices'] | CLOSE_APPROACH_PUBLISHED['alerts']) - devices_data.keys():
+            unpublish_close_approach_device(device_id)
+        devices = {}
+        for device_id in device_ids:
+            level, distance = publish_close_approach_level(device_id)
+            if distance is not None:
+                devices[device_id] = (level, distance)
+
+    return devices
+
+'''
+Close approach detection of one device against the fleet snapshot (one row of distances), at each uplink
+
+Only the pairs of the device, and the levels of the device and of its previous and new close boats, are updated.
+Return (alert level, distance to the nearest boat in meters) of the device
+'''
+@STAGE_TIMER.timed('close_approach')
+def check_close_approach_device(device_id, devices_data):
+    others = [other for other in devices_data.keys() if other != device_id]
+    track = devices_data[device_id]
+    latitudes = np.array([devices_data[other].latitude[-1] for other in others])
+    longitudes = np.array([devices_data[other].longitude[-1] for other in others])
+    distances = haversine_distance(track.latitude[-1], track.longitude[-1], latitudes, longitudes) * 1000
+    indexes = np.flatnonzero(distances <= max(CLOSE_APPROACH_RADII.values()))
+    close = {others[index]: distance for index, distance in zip(indexes.tolist(), distances[indexes].tolist())}
+
+    with CLOSE_APPROACH_LOCK:
+        previous = set(CLOSE_APPROACH_NEIGHBOURS.get(device_id, ()))
+        affected = previous | close.keys()
+        for other in previous - close.keys():
+            forget_close_pair(tuple(sorted((device_id, other))))
+        # the previous close boats which left the fleet are forgotten with all their pairs
+        for other in previous - devices_data.keys():
+            for neighbour in list(CLOSE_APPROACH_NEIGHBOURS.get(other, ())):
+                forget_close_pair(tuple(sorted((other, neighbour))))
+                affected.add(neighbour)
+            unpublish_close_approach_device(other)
+        for other, distance in close.items():
+            record_close_pair(tuple(sorted((device_id, other))), distance)
+        for other in (affected & devices_data.keys()) - {device_id}:
+            publish_close_approach_level(other)
+        return publish_close_approach_level(device_id)
+
+'''
+Return True if the whole fleet must be checked for close approaches
+'''
+def full_close_approach_due():
+    return time.time() - CLOSE_APPROACH_PUBLISHED['last_full_check'] >= CLOSE_APPROACH_FULL_INTERVAL
+
+'''
+Record a close pair (sorted device ids) and publish its distance (CLOSE_APPROACH_LOCK held)
+
+In sharded mode, a shard only publishes its own devices (and the pairs of which it owns the first device)
+'''
+def record_close_pair(pair, distance):
+    CLOSE_APPROACH_PAIRS[pair] = distance
+    CLOSE_APPROACH_NEIGHBOURS.setdefault(pair[0], set()).add(pair[1])
+    CLOSE_APPROACH_NEIGHBOURS.setdefault(pair[1], set()).add(pair[0])
+    if owns_device(pair[0]):
+        CLOSE_APPROACH_DISTANCE_METRIC.labels(device_id=pair[0], other_device_id=pair[1]).set(distance)
+        CLOSE_APPROACH_PUBLISHED['pairs'].add(pair)
+
+'''
+Forget a pair which is not close anymore and remove its series (CLOSE_APPROACH_LOCK held)
+'''
+def forget_close_pair(pair):
+    CLOSE_APPROACH_PAIRS.pop(pair, None)
+    for device_id, other in (pair, pair[::-1]):
+        neighbours = CLOSE_APPROACH_NEIGHBOURS.get(device_id)
+        if neighbours is not None:
+            neighbours.discard(other)
+            if len(neighbours) == 0:
+                del CLOSE_APPROACH_NEIGHBOURS[device_id]
+    if pair in CLOSE_APPROACH_PUBLISHED['pairs']:
+        CLOSE_APPROACH_DISTANCE_METRIC.remove(*pair)
+        CLOSE_APPROACH_PUBLISHED['pairs'].discard(pair)
+
+'''
+Publish the alert level of a device from its close pairs, return (level, distance to the nearest boat or None)
+(CLOSE_APPROACH_LOCK held)
+'''
+def publish_close_approach_level(device_id):
+    distances = [CLOSE_APPROACH_PAIRS[tuple(sorted((device_id, other)))] for other in CLOSE_APPROACH_NEIGHBOURS.get(device_id, ())]
+    distance = min(distances) if len(distances) > 0 else None
+    # the level only depends on the distance, the nearest boat gives the level of the device
+    level = 0 if distance is None else sum(1 for radius in CLOSE_APPROACH_RADII.values() if distance <= radius)
+    if not owns_device(device_id):
+        return level, distance
+    CLOSE_APPROACH_ALERT_METRIC.labels(device_id=device_id).set(level)
+    CLOSE_APPROACH_PUBLISHED['alerts'].add(device_id)
+    if distance is not None:
+        CLOSE_APPROACH_MIN_DISTANCE_METRIC.labels(device_id=device_id).set(distance)
+        CLOSE_APPROACH_PUBLISHED['devices'].add(device_id)
+    elif device_id in CLOSE_APPROACH_PUBLISHED['devices']:
+        CLOSE_APPROACH_MIN_DISTANCE_METRIC.remove(device_id)
+        CLOSE_APPROACH_PUBLISHED['devices'].discard(device_id)
+    return level, distance
+
+'''
+Remove the close approach series (alert level, distance to the nearest boat) of a device which left the fleet
+(CLOSE_APPROACH_LOCK held)
+'''
+def unpublish_close_approach_device(device_id):
+    if device_id in CLOSE_APPROACH_PUBLISHED['alerts']:
+        CLOSE_APPROACH_ALERT_METRIC.remove(device_id)
+        CLOSE_APPROACH_PUBLISHED['alerts'].discard(device_id)
+    if device_id in CLOSE_APPROACH_PUBLISHED['devices']:
+        CLOSE_APPROACH_MIN_DISTANCE_METRIC.remove(device_id)
+        CLOSE_APPROACH_PUBLISHED['devices'].discard(device_id)
+
 #############################################################################################
 #                                           DEBUG                                           #
 #############################################################################################
@@ -520,16 +1029,9 @@ def debug_send_data():
         try:
             for device_id in devices:
                 current_time = time.time()
-                # Get data from Prometheus limited to 1 and to the device ID
-                previous_data = json.loads(urllib.request.urlopen(PROMETHEUS + '/api/v1/query?query={device_id="' + device_id + '"}').read().decode())
-
-                previous_data = previous_data['data']['result']
-
-                prev_values = {item['metric']['__name__']: item['value'][1] for item in previous_data}
 
                 # Simulated object data for debugging
                 object_data = {
-                    'device_id': device_id,
                     'acceleration_x': 0.0,
                     'acceleration_y': 0.0,
                     'acceleration_z': 0.0,
@@ -537,48 +1039,9 @@ def debug_send_data():
                     'temperature': 25.0,
                     'latitude': points[step][1] if device_id == 'debug_device' else 16.051108320558086, 
                     'longitude': points[step][0] if device_id == 'debug_device' else 108.22507352428653,
-                    'speed': 0.0,
-                    'distance': 0.0,
-                    'date': current_time,
                 }
 
-                distance, speed = calculate_distance_speed(object_data, prev_values, current_time)
-
-                object_data['device_id'] = device_id
-                object_data['speed'] = speed
-                object_data['distance'] = distance
-
-                datas = data_merging(object_data)
-
-                object_data['collision_detection']= check_collision(device_id, datas.items())
-                all_datas = datas[device_id] if device_id in datas else {}
-                state = check_state(object_data, all_datas)
-
-                # Update Prometheus metrics
-                ACCELERATION_X_METRIC.labels(device_id=device_id).set(object_data['acceleration_x'])
-                ACCELERATION_Y_METRIC.labels(device_id=device_id).set(object_data['acceleration_y'])
-                ACCELERATION_Z_METRIC.labels(device_id=device_id).set(object_data['acceleration_z'])
-                BATTERY_METRIC.labels(device_id=device_id).set(object_data['battery'])
-                TEMPERATURE_METRIC.labels(device_id=device_id).set(object_data['temperature'])
-
-                LATITUDE_METRIC.labels(device_id=device_id).set(object_data['latitude'])
-                LONGITUDE_METRIC.labels(device_id=device_id).set(object_data['longitude'])
-                STATUT_METRIC.labels(device_id=device_id).set(state)
-                STATUT_NAME_METRIC._labelnames = ['device_id']
-                STATUT_NAME_METRIC._states = STATE_LIST
-                STATUT_NAME_METRIC.labels(device_id=device_id).state(STATE_LIST[state])
-                SPEED_METRIC.labels(device_id=device_id).set(object_data['speed'])
-                DISTANCE_METRIC.labels(device_id=device_id).set(object_data['distance'])
-
-                DATE_METRIC.labels(device_id=device_id).set(object_data['date'])
-                COLLISON_DETECTION_METRIC.labels(device_id=device_id).set(object_data['collision_detection'])
-
-                print(f"Debug data sent: {object_data}")
-
-                
-                # Push metrics to Prometheus Pushgateway with the job name 'mqtt_listener'
-                
-                push_to_gateway(PUSHGATEWAY, job='data-ship', registry=registry)
+                process_uplink(device_id, object_data, current_time)
 
                 time.sleep(2)
 
@@ -594,12 +1057,37 @@ def debug_send_data():
 #############################################################################################
 '''
 On_message function for recieved message from mqtt
+
+Only decode the message and queue it, the processing is done by the ingest pipeline workers
 '''
 def on_message(mosq, obj, msg):
+    handle_payload(msg.payload, time.time())
+
+'''
+On_message function of the main process in sharded mode: the raw payload goes to the shard of the device
+
+The partition key is the device name, as the device ids of the workers, so a worker knows its devices
+(see ShardLink.owns) even before they report
+'''
+def on_message_sharded(mosq, obj, msg):
+    try:
+        device_id = json.loads(msg.payload.decode())['deviceName']
+    except json.JSONDecodeError as e:
+        print(f"Failed to decode JSON payload: {e}")
+        return
+    except KeyError as e:
+        print(f"Missing key in JSON payload: {e}")
+        return
+    if not SHARD_COORDINATOR.dispatch(device_id, msg.payload, time.time()):
+        METRICS_PUBLISHER.mark_dirty()
+
+'''
+Decode a message payload received at 'current_time' and queue it for the ingest pipeline
+'''
+def handle_payload(raw_payload, current_time):
     try:
-        current_time = time.time()
         # Parse the JSON payload
-        payload = json.loads(msg.payload.decode())
+        payload = json.loads(raw_payload.decode())
 
         # Extract device ID
         device_id = payload['deviceName']
@@ -609,58 +1097,138 @@ def on_message(mosq, obj, msg):
 
         print(f"Received data: {payload}")
 
-        # Get data from Prometheus limited to 1 and to the device ID
-        
-        previous_data = json.loads(urllib.request.urlopen(PROMETHEUS + '/api/v1/query?query={device_id="' + device_id + '"}').read().decode())
+        INGEST_PIPELINE.submit(device_id, device_id, object_data, current_time)
+    except json.JSONDecodeError as e:
+        print(f"Failed to decode JSON payload: {e}")
+    except KeyError as e:
+        print(f"Missing key in JSON payload: {e}")
+    except Exception as e:
+        print(f"Failed to queue message: {e}")
 
-        previous_data = previous_data['data']['result']
+'''
+Distance and speed from the previous position of the device, added to its data ('object_data')
+'''
+def prepare_uplink(device_id, object_data, current_time):
+    # Get previous position of the device (local cache, Prometheus on cold start)
+    prev_values = get_previous_values(device_id)
 
-        prev_values = {item['metric']['__name__']: item['value'][1] for item in previous_data}
-        
-        distance, speed = calculate_distance_speed(object_data, prev_values, current_time)
+    distance, speed = calculate_distance_speed(object_data, prev_values, current_time)
+    LAST_FIX_CACHE.update(device_id, current_time, object_data['latitude'], object_data['longitude'])
 
-        object_data['date'] = current_time
-        object_data['device_id'] = device_id
-        object_data['speed'] = speed
-        object_data['distance'] = distance
+    object_data['date'] = current_time
+    object_data['device_id'] = device_id
+    object_data['speed'] = speed
+    object_data['distance'] = distance
+    return object_data
+
+'''
+Update the Prometheus metrics of a device from its data and state
+'''
+def set_device_metrics(device_id, object_data, state):
+    ACCELERATION_X_METRIC.labels(device_id=device_id).set(object_data['acceleration_x'])
+    ACCELERATION_Y_METRIC.labels(device_id=device_id).set(object_data['acceleration_y'])
+    ACCELERATION_Z_METRIC.labels(device_id=device_id).set(object_data['acceleration_z'])
+    BATTERY_METRIC.labels(device_id=device_id).set(object_data['battery'])
+    TEMPERATURE_METRIC.labels(device_id=device_id).set(object_data['temperature'])
+
+    LATITUDE_METRIC.labels(device_id=device_id).set(object_data['latitude'])
+    LONGITUDE_METRIC.labels(device_id=device_id).set(object_data['longitude'])
+    STATUT_METRIC.labels(device_id=device_id).set(state)
+    STATUT_NAME_METRIC._labelnames = ['device_id']
+    STATUT_NAME_METRIC._states = STATE_LIST
+    STATUT_NAME_METRIC.labels(device_id=device_id).state(STATE_LIST[state])
+    SPEED_METRIC.labels(device_id=device_id).set(object_data['speed'])
+    DISTANCE_METRIC.labels(device_id=device_id).set(object_data['distance'])
+
+    DATE_METRIC.labels(device_id=device_id).set(object_data['date'])
+    COLLISON_DETECTION_METRIC.labels(device_id=device_id).set(object_data['collision_detection'])
+
+'''
+Process the data of a device received at 'current_time': state, collision, and push of the metrics
+'''
+@STAGE_TIMER.timed('uplink')
+def process_uplink(device_id, object_data, current_time):
+    try:
+        prepare_uplink(device_id, object_data, current_time)
 
         datas = data_merging(object_data)
 
-        object_data['collision_detection']= check_collision(device_id, datas.items())
-        all_datas = datas[device_id] if device_id in datas else {}
+        if COLLISION_METHOD == 'cpa':
+            object_data['collision_detection']= check_collision_cpa(device_id, datas)
+        else:
+            object_data['collision_detection']= check_collision(device_id, datas.items())
+        if full_close_approach_due():
+            check_close_approach(datas)
+        else:
+            check_close_approach_device(device_id, datas)
+        publish_fleet_record(device_id, datas)
+        all_datas = datas.get(device_id)
         state = check_state(object_data, all_datas)
 
         # Update Prometheus metrics
-        ACCELERATION_X_METRIC.labels(device_id=device_id).set(object_data['acceleration_x'])
-        ACCELERATION_Y_METRIC.labels(device_id=device_id).set(object_data['acceleration_y'])
-        ACCELERATION_Z_METRIC.labels(device_id=device_id).set(object_data['acceleration_z'])
-        BATTERY_METRIC.labels(device_id=device_id).set(object_data['battery'])
-        TEMPERATURE_METRIC.labels(device_id=device_id).set(object_data['temperature'])
-
-        LATITUDE_METRIC.labels(device_id=device_id).set(object_data['latitude'])
-        LONGITUDE_METRIC.labels(device_id=device_id).set(object_data['longitude'])
-        STATUT_METRIC.labels(device_id=device_id).set(state)
-        STATUT_NAME_METRIC._labelnames = ['device_id']
-        STATUT_NAME_METRIC._states = STATE_LIST
-        STATUT_NAME_METRIC.labels(device_id=device_id).state(STATE_LIST[state])
-        SPEED_METRIC.labels(device_id=device_id).set(object_data['speed'])
-        DISTANCE_METRIC.labels(device_id=device_id).set(object_data['distance'])
-
-        DATE_METRIC.labels(device_id=device_id).set(object_data['date'])
-        COLLISON_DETECTION_METRIC.labels(device_id=device_id).set(object_data['collision_detection'])
+        set_device_metrics(device_id, object_data, state)
 
         print(f"Debug data sent: {object_data}")
-                
-        # Push metrics to Prometheus Pushgateway with the job name 'mqtt_listener'
-        
-        push_to_gateway(PUSHGATEWAY, job='data-ship', registry=registry)
-    except json.JSONDecodeError as e:
-        print(f"Failed to decode JSON payload: {e}")
+
+        # Metrics are pushed to Prometheus Pushgateway with the job name 'data-ship' by the publisher (coalesced)
+        METRICS_PUBLISHER.mark_dirty()
     except KeyError as e:
         print(f"Missing key in JSON payload: {e}")
     except Exception as e:
         print(f"Failed to push metrics to Pushgateway: {e}")
 
+'''
+Process the messages (device_id, object_data, current_time) of a micro-batch at once
+
+All the fixes are added to the tracks first, then the fleet is checked once (collisions,
+close approaches) and the state of each device which sent data is calculated from its last message
+'''
+@STAGE_TIMER.timed('batch')
+def process_batch(messages):
+    latest = {}
+    now = max(current_time for device_id, object_data, current_time in messages)
+    for device_id, object_data, current_time in messages:
+        try:
+            prepare_uplink(device_id, object_data, current_time)
+            store_fix(object_data)
+            latest[device_id] = object_data
+        except KeyError as e:
+            print(f"Missing key in JSON payload: {e}")
+        except Exception as e:
+            print(f"Failed to process message of {device_id}: {e}")
+    if len(latest) == 0:
+        return
+
+    try:
+        datas = fleet_view(now)
+        if COLLISION_METHOD == 'cpa':
+            colliding = check_collisions_cpa(list(latest.keys()), datas)
+        else:
+            colliding = check_collisions_fleet(datas)
+        check_close_approach(datas)
+
+        for device_id, object_data in latest.items():
+            try:
+                object_data['collision_detection'] = 1 if device_id in colliding else 0
+                publish_fleet_record(device_id, datas)
+                state = check_state(object_data, datas.get(device_id))
+                set_device_metrics(device_id, object_data, state)
+            except KeyError as e:
+                print(f"Missing key in JSON payload: {e}")
+
+        print(f"Debug batch sent: {len(messages)} messages of {len(latest)} devices")
+
+        # A single push for the whole batch
+        METRICS_PUBLISHER.mark_dirty()
+    except Exception as e:
+        print(f"Failed to process batch: {e}")
+
+if INGEST_MODE == 'batch':
+    INGEST_PIPELINE = MicroBatcher(process_batch, INGEST_BATCH_WINDOW, INGEST_BATCH_MAX_SIZE, INGEST_BATCH_SIZE_METRIC, INGEST_BATCH_LATENCY_METRIC)
+else:
+    INGEST_PIPELINE = IngestPipeline(process_uplink, INGEST_WORKERS, INGEST_QUEUE_SIZE, INGEST_QUEUE_POLICY, INGEST_LATENCY_METRIC, INGEST_DROPPED_METRIC)
+INGEST_QUEUE_DEPTH_METRIC.set_function(INGEST_PIPELINE.depth)
+
 '''
 On_publish function to send message on the queue mqtt
 '''
@@ -689,24 +1257,8 @@ def calculate_distance_speed(data, prev_values, current_time):
         lat1, lon1 = float(prev_values['latitude']), float(prev_values['longitude'])
         lat2, lon2 = float(data['latitude']), float(data['longitude'])
 
-        # Radius of the Earth in km
-        R = 6371.0
-
-        # Convert latitude and longitude from degrees to radians
-        lat1 = math.radians(lat1)
-        lon1 = math.radians(lon1)
-        lat2 = math.radians(lat2)
-        lon2 = math.radians(lon2)
-
-        # Calculate the change in coordinates
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-
-        # Haversine formula
-        a = math.sin(dlat / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2)**2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-        distance = R * c
+        # Haversine formula (km)
+        distance = float(haversine_distance(lat1, lon1, lat2, lon2))
 
         # Calculate time difference in hours
         elapsed_time = (current_time - float(prev_values["date"])) / 3600.0
@@ -728,21 +1280,86 @@ def calculate_distance_speed(data, prev_values, current_time):
 #                                           MAIN                                            #
 #############################################################################################
 
+'''
+Start the background services of the consumer (history, write-ahead log, archive, metrics publication, ingest pipeline, zones)
+'''
+def start_services():
+    restored = WAL is not None and restore_from_wal()
+    if TRACK_STORE_WARM_START and not restored:
+        warm_track_store()
+    if WAL is not None:
+        try:
+            WAL.start()
+        except Exception as e:
+            # e.g. no /app volume outside the container: the uplinks are not logged
+            print(f"Failed to open the write-ahead log {WAL.path}, running without it: {e}")
+    if TRACK_ARCHIVE is not None:
+        TRACK_ARCHIVE.start()
+        atexit.register(TRACK_ARCHIVE.flush)
+
+    METRICS_PUBLISHER.start()
+    INGEST_PIPELINE.start()
+    if STACK_SAMPLER is not None:
+        STACK_SAMPLER.start()
+
+    ZONE_REGISTRY.refresh()
+    ZONE_REGISTRY.start()
+
+'''
+Main function of a worker process in sharded mode: process the payloads dispatched to the shard 'index'
+'''
+def run_shard(index, shards, inbox, fixes, remote_fixes, fleet_snapshot_name=None):
+    global SHARD_LINK, FLEET_SNAPSHOT_WRITER
+    if WAL is not None:
+        # each shard logs the uplinks of its own devices
+        WAL.path = f'{WAL_PATH}.shard{index}'
+    SHARD_LINK = ShardLink(index, shards, fixes, remote_fixes, forward=fleet_snapshot_name is None, dropped_metric=SHARD_DROPPED_FIXES_METRIC)
+    if fleet_snapshot_name is not None:
+        # the records of the devices which left the time window are freed when the slots of the shard are full
+        FLEET_SNAPSHOT_WRITER = FleetSnapshotWriter(SharedFleetSnapshot(fleet_snapshot_name), index * TRACK_MAX_DEVICES, TRACK_MAX_DEVICES, TRACK_WINDOW_SECONDS)
+    METRICS_PUBLISHER.grouping_key = {'shard': str(index)}
+    METRICS_PUBLISHER.port = METRICS_PORT + index
+
+    start_services()
+    SHARD_LINK.start(apply_fix)
+    print(f"Shard {index + 1}/{shards} started")
+
+    while True:
+        raw_payload, current_time = inbox.get()
+        handle_payload(raw_payload, current_time)
+
 if __name__ == '__main__':
     # Test Pushgateway connection before starting the MQTT client
     print(f"Connecting to Pushgateway at {PUSHGATEWAY}...")
     print(f"Connecting to Prometheus at {PROMETHEUS}...")
-    try:
-        urllib.request.urlopen(PUSHGATEWAY+'/metrics')
-        print("Pushgateway connection successful.")
-    except Exception as e:
-        print(f"Pushgateway connection failed: {e}")
-        exit(1)
+    if METRICS_MODE == 'push':
+        try:
+            HTTP_CLIENT.get('pushgateway', PUSHGATEWAY+'/metrics').raise_for_status()
+            print("Pushgateway connection successful.")
+        except Exception as e:
+            print(f"Pushgateway connection failed: {e}")
+            exit(1)
 
     client = paho.Client()
-    client.on_message = on_message
     client.on_publish = on_publish
 
+    if SHARDS > 1:
+        # the main process only dispatches the messages to the shards
+        shard_args = ()
+        if SHARD_FLEET_VIEW == 'shared_memory':
+            fleet_snapshot = SharedFleetSnapshot(capacity=SHARDS * TRACK_MAX_DEVICES, create=True, zone_steps=PREDICTION_STEPS)
+            atexit.register(fleet_snapshot.unlink)
+            shard_args = (fleet_snapshot.name,)
+        SHARD_COORDINATOR = ShardCoordinator(SHARDS, run_shard, SHARD_QUEUE_SIZE, SHARD_DROPPED_METRIC, shard_args, SHARD_FIXES_QUEUE_SIZE, SHARD_DROPPED_FIXES_METRIC)
+        SHARD_COORDINATOR.start()
+        METRICS_PUBLISHER.grouping_key = {'shard': 'dispatcher'}
+        METRICS_PUBLISHER.port = METRICS_PORT + SHARDS
+        METRICS_PUBLISHER.start()
+        client.on_message = on_message_sharded
+    else:
+        start_services()
+        client.on_message = on_message
+
     connect_mqtt(client)  # Try to connect to the MQTT broker
 
     topic = "application/"+ APP_NUMBER + "/device/+/event/up"
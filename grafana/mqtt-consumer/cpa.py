@@ -0,0 +1,81 @@
+import numpy as np
+
+from geodesy import EARTH_RADIUS_KM
+
+EARTH_RADIUS_M = EARTH_RADIUS_KM * 1000
+
+#############################################################################################
+#                          CLOSEST POINT OF APPROACH (CPA / TCPA)                           #
+#############################################################################################
+
+'''
+Offsets in meters (east, north) of the points from a reference point (local equirectangular projection)
+'''
+def local_offsets(lat0, lon0, latitudes, longitudes):
+    east = EARTH_RADIUS_M * np.radians(np.subtract(longitudes, lon0)) * np.cos(np.radians(lat0))
+    north = EARTH_RADIUS_M * np.radians(np.subtract(latitudes, lat0))
+    return east, north
+
+'''
+Velocity (east, north) in m/s of each track, from its last 2 fixes
+
+'tracks' is a list of track snapshots, a track with a single fix is considered as stopped
+'''
+def track_velocities(tracks):
+    count = len(tracks)
+    last = np.empty((3, count))
+    previous = np.empty((3, count))
+    for index, track in enumerate(tracks):
+        last[:, index] = (track.date[-1], track.latitude[-1], track.longitude[-1])
+        k = -2 if len(track) > 1 else -1
+        previous[:, index] = (track.date[k], track.latitude[k], track.longitude[k])
+
+    east, north = local_offsets(last[1], last[2], previous[1], previous[2])
+    elapsed = last[0] - previous[0]
+    moving = elapsed > 0
+    v_east = np.zeros(count)
+    v_north = np.zeros(count)
+    # the offsets go from the last fix to the previous one
+    v_east[moving] = -east[moving] / elapsed[moving]
+    v_north[moving] = -north[moving] / elapsed[moving]
+    return v_east, v_north
+
+'''
+Closest point of approach of pairs of boats, in closed form and vectorized over the pairs
+
+'east', 'north' are the relative positions (m) and 'v_east', 'v_north' the relative velocities (m/s)
+of the other boats. The time of closest approach is limited to [0, horizon] seconds.
+Return (distances at the closest approach in meters, times of the closest approach in seconds)
+'''
+def closest_point_of_approach(east, north, v_east, v_north, horizon=None):
+    east, north, v_east, v_north = np.broadcast_arrays(*(np.asarray(value, dtype=np.float64) for value in (east, north, v_east, v_north)))
+    speed2 = v_east**2 + v_north**2
+    times = np.zeros(east.shape)
+    relative = speed2 > 1e-12
+    times[relative] = -(east[relative] * v_east[relative] + north[relative] * v_north[relative]) / speed2[relative]
+    times = np.clip(times, 0, horizon if horizon is not None else np.inf)
+    distances = np.hypot(east + v_east * times, north + v_north * times)
+    return distances, times
+
+'''
+Closest point of approach between each boat of 'indexes' and all boats of the fleet, in one vectorized pass
+
+With the 'dates' of the fixes, every boat is first moved with its velocity to the date of the fix of
+the checked boat (the last fixes of the fleet are not simultaneous), the times and the horizon count from it.
+Return (distances, times) as (len(indexes), fleet) arrays (a checked boat gets inf / 0 with itself)
+'''
+def fleet_cpa_rows(indexes, latitudes, longitudes, v_east, v_north, horizon=None, dates=None):
+    indexes = np.asarray(indexes, dtype=np.intp)
+    latitudes, longitudes, v_east, v_north = (np.asarray(value, dtype=np.float64) for value in (latitudes, longitudes, v_east, v_north))
+    # one row by checked boat, relative to its own last position
+    east, north = local_offsets(latitudes[indexes, None], longitudes[indexes, None], latitudes[None, :], longitudes[None, :])
+    if dates is not None:
+        dates = np.asarray(dates, dtype=np.float64)
+        elapsed = dates[indexes, None] - dates[None, :]
+        east = east + v_east[None, :] * elapsed
+        north = north + v_north[None, :] * elapsed
+    distances, times = closest_point_of_approach(east, north, v_east[None, :] - v_east[indexes, None], v_north[None, :] - v_north[indexes, None], horizon)
+    rows = np.arange(len(indexes))
+    distances[rows, indexes] = np.inf
+    times[rows, indexes] = 0
+    return distances, times
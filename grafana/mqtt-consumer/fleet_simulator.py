@@ -0,0 +1,231 @@
+import argparse
+import json
+import os
+import sys
+import numpy as np
+import shapely
+from shapely.geometry import LineString, shape
+
+from geodesy import haversine_distance_in_meters, initial_bearing, destination_point
+
+'''
+Synthetic fleet of boats on the Han river, to load-test the collision, state and zone checks
+
+Deterministic for a given seed. Usage: python fleet_simulator.py --boats 100 --duration 600 > uplinks.jsonl
+'''
+
+HAN_RIVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'datas', 'zone-han-river.geojson')
+
+#############################################################################################
+#                                     FLEET SIMULATOR                                       #
+#############################################################################################
+
+'''
+Boats moving inside a zone (first polygon of a geojson file), reporting their GPS position every 'period' seconds
+
+ - most boats go from a random point of the zone to another, at a speed between 'min_speed' and 'max_speed' (m/s),
+   so their routes cross each other
+ - 'ferry_ratio' of the boats are ferries, going back and forth across the river
+ - every 'near_miss_interval' seconds, a boat is sent to pass at 5-25 m of the predicted position of
+   another one (the near misses are listed in 'events')
+ - the reported positions have a gaussian noise of 'gps_noise' meters
+'''
+class FleetSimulator:
+    def __init__(self, boats=10, seed=0, zone_file=HAN_RIVER, period=5.0, gps_noise=5.0, min_speed=1.0, max_speed=6.0, ferry_ratio=0.1, near_miss_interval=60.0, start=0.0):
+        self.boats = boats
+        self.period = period
+        self.gps_noise = gps_noise
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.near_miss_interval = near_miss_interval
+        self.rng = np.random.default_rng(seed)
+        self.zone = load_zone(zone_file)
+        self.date = start
+        # (date, device_id, other_device_id, 'near_miss')
+        self.events = []
+
+        self.device_ids = [f'sim-boat-{index}' for index in range(boats)]
+        self.latitudes, self.longitudes = self.random_points(boats)
+        self.speeds = self.rng.uniform(min_speed, max_speed, boats)
+        self.target_latitudes, self.target_longitudes = self.random_points(boats)
+        self.ferries = np.zeros(boats, dtype=bool)
+        self.ferries[:int(round(boats * ferry_ratio))] = True
+        # the 2 terminals of each ferry, across the river
+        self.terminals = {}
+        for index in np.nonzero(self.ferries)[0]:
+            self.terminals[index] = self.crossing(self.latitudes[index], self.longitudes[index])
+            self.latitudes[index], self.longitudes[index] = self.terminals[index][0]
+            self.target_latitudes[index], self.target_longitudes[index] = self.terminals[index][1]
+
+        # each boat reports at its own phase in the period
+        self.next_reports = start + self.rng.uniform(0, period, boats)
+        self.batteries = self.rng.uniform(60, 100, boats)
+        self.next_near_miss = start + near_miss_interval
+
+    '''
+    'count' random points inside the zone (latitudes, longitudes)
+    '''
+    def random_points(self, count):
+        min_lon, min_lat, max_lon, max_lat = self.zone.bounds
+        latitudes = np.empty(0)
+        longitudes = np.empty(0)
+        while len(latitudes) < count:
+            candidates_lat = self.rng.uniform(min_lat, max_lat, 4 * count)
+            candidates_lon = self.rng.uniform(min_lon, max_lon, 4 * count)
+            inside = shapely.contains_xy(self.zone, candidates_lon, candidates_lat)
+            latitudes = np.concatenate((latitudes, candidates_lat[inside]))
+            longitudes = np.concatenate((longitudes, candidates_lon[inside]))
+        return latitudes[:count], longitudes[:count]
+
+    '''
+    Terminals ((lat, lon), (lat, lon)) of the shortest crossing of the zone through a point (10% away from the banks)
+    '''
+    def crossing(self, latitude, longitude):
+        best = None
+        for bearing in np.linspace(0, np.pi, 36, endpoint=False):
+            end1 = destination_point(latitude, longitude, 5.0, bearing)
+            end2 = destination_point(latitude, longitude, 5.0, bearing + np.pi)
+            chord = LineString([(end1[1], end1[0]), (end2[1], end2[0])]).intersection(self.zone)
+            # keep the part of the line through the point
+            parts = getattr(chord, 'geoms', [chord])
+            for part in parts:
+                if part.is_empty or part.length == 0 or part.distance(shapely.Point(longitude, latitude)) > 1e-9:
+                    continue
+                if best is None or part.length < best.length:
+                    best = part
+        if best is None:
+            return (latitude, longitude), (latitude, longitude)
+        (lon1, lat1), (lon2, lat2) = best.interpolate(0.1, normalized=True).coords[0], best.interpolate(0.9, normalized=True).coords[0]
+        return (lat1, lon1), (lat2, lon2)
+
+    '''
+    Move all boats for 'dt' seconds
+    '''
+    def step(self, dt):
+        distances = haversine_distance_in_meters(self.latitudes, self.longitudes, self.target_latitudes, self.target_longitudes)
+        bearings = initial_bearing(self.latitudes, self.longitudes, self.target_latitudes, self.target_longitudes)
+        travel = np.minimum(self.speeds * dt, distances)
+        latitudes, longitudes = destination_point(self.latitudes, self.longitudes, travel / 1000, bearings)
+
+        # the boats can not leave the zone (the river is not straight): they choose another destination
+        inside = shapely.contains_xy(self.zone, longitudes, latitudes)
+        self.latitudes = np.where(inside, latitudes, self.latitudes)
+        self.longitudes = np.where(inside, longitudes, self.longitudes)
+        self.date += dt
+
+        arrived = (travel >= distances) | ~inside
+        for index in np.nonzero(arrived)[0]:
+            self.new_destination(index)
+
+        if self.near_miss_interval > 0 and self.date >= self.next_near_miss:
+            self.next_near_miss += self.near_miss_interval
+            self.near_miss()
+
+    def new_destination(self, index):
+        if self.ferries[index]:
+            first, second = self.terminals[index]
+            # go to the terminal the ferry is not at
+            at_first = haversine_distance_in_meters(self.latitudes[index], self.longitudes[index], *first) < 1.0
+            self.target_latitudes[index], self.target_longitudes[index] = second if at_first else first
+            return
+        latitudes, longitudes = self.random_points(1)
+        self.target_latitudes[index], self.target_longitudes[index] = latitudes[0], longitudes[0]
+        self.speeds[index] = self.rng.uniform(self.min_speed, self.max_speed)
+
+    '''
+    Send a boat to pass close to the predicted position of another one, in 'horizon' seconds
+
+    The first boat must still be going straight at that time, the second one must be able to reach the
+    meeting point at a plausible speed, in a straight line inside the zone
+    '''
+    def near_miss(self, horizon=30.0):
+        remaining = haversine_distance_in_meters(self.latitudes, self.longitudes, self.target_latitudes, self.target_longitudes)
+        firsts = np.nonzero(~self.ferries & (remaining > self.speeds * horizon))[0]
+        if len(firsts) == 0:
+            return
+        first = self.rng.choice(firsts)
+        bearing = initial_bearing(self.latitudes[first], self.longitudes[first], self.target_latitudes[first], self.target_longitudes[first])
+        meeting = destination_point(self.latitudes[first], self.longitudes[first], self.speeds[first] * horizon / 1000, bearing)
+        miss_distance = self.rng.uniform(5, 25)
+        latitude, longitude = destination_point(meeting[0], meeting[1], miss_distance / 1000, bearing + self.rng.choice([-1, 1]) * np.pi / 2)
+        if not shapely.contains_xy(self.zone, longitude, latitude):
+            return
+
+        speeds = haversine_distance_in_meters(self.latitudes, self.longitudes, latitude, longitude) / horizon
+        seconds = [
+            index for index in np.nonzero(~self.ferries & (speeds >= self.min_speed) & (speeds <= self.max_speed * 1.5))[0]
+            if index != first and self.zone.contains(LineString([(self.longitudes[index], self.latitudes[index]), (longitude, latitude)]))
+        ]
+        if len(seconds) == 0:
+            return
+        second = self.rng.choice(seconds)
+        self.target_latitudes[second], self.target_longitudes[second] = latitude, longitude
+        self.speeds[second] = speeds[second]
+        self.events.append((self.date + horizon, self.device_ids[first], self.device_ids[second], 'near_miss'))
+
+    '''
+    Decoded uplinks ({'device_id', 'date', 'latitude', 'longitude', 'acceleration_*', 'battery', 'temperature'})
+    in date order, for 'duration' seconds (forever if None)
+    '''
+    def uplinks(self, duration=None, tick=1.0):
+        end = None if duration is None else self.date + duration
+        while end is None or self.date < end:
+            self.step(tick)
+            due = np.nonzero(self.next_reports <= self.date)[0]
+            for index in due[np.argsort(self.next_reports[due])]:
+                yield self.report(index)
+            self.next_reports[due] += self.period
+
+    def report(self, index):
+        noise = self.rng.normal(0, self.gps_noise, 2)
+        latitude, longitude = destination_point(self.latitudes[index], self.longitudes[index], np.hypot(*noise) / 1000, np.arctan2(noise[0], noise[1]))
+        self.batteries[index] = max(self.batteries[index] - 0.001, 0)
+        acceleration = self.rng.normal(0, 0.05, 3)
+        return {
+            'device_id': self.device_ids[index],
+            'date': float(self.next_reports[index]),
+            'latitude': float(latitude),
+            'longitude': float(longitude),
+            'acceleration_x': float(acceleration[0]),
+            'acceleration_y': float(acceleration[1]),
+            'acceleration_z': float(acceleration[2] + 1),
+            'battery': round(float(self.batteries[index]), 2),
+            'temperature': round(float(self.rng.normal(28, 0.5)), 1),
+        }
+
+'''
+First polygon of a geojson file
+'''
+def load_zone(file_name):
+    with open(file_name) as file:
+        data = json.load(file)
+    features = data['features'] if data.get('type') == 'FeatureCollection' else [data]
+    return shape(features[0]['geometry'])
+
+'''
+ChirpStack uplink payload (as received on application/<app>/device/<devEUI>/event/up) of a decoded uplink
+'''
+def chirpstack_payload(uplink):
+    object_data = {key: value for key, value in uplink.items() if key not in ('device_id', 'date')}
+    return {
+        'deviceName': uplink['device_id'],
+        'devEUI': f"{int(uplink['device_id'].rsplit('-', 1)[-1]):016x}",
+        'object': object_data,
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic fleet on the Han river, one uplink (JSON) by line')
+    parser.add_argument('--boats', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=600, help='simulated seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--period', type=float, default=5.0, help='seconds between 2 uplinks of a boat')
+    parser.add_argument('--gps-noise', type=float, default=5.0, help='standard deviation of the GPS positions (m)')
+    parser.add_argument('--format', choices=['chirpstack', 'decoded'], default='chirpstack')
+    parser.add_argument('--zone', default=HAN_RIVER, help='geojson file of the zone')
+    args = parser.parse_args()
+
+    simulator = FleetSimulator(args.boats, args.seed, args.zone, args.period, args.gps_noise)
+    for uplink in simulator.uplinks(args.duration):
+        sys.stdout.write(json.dumps(chirpstack_payload(uplink) if args.format == 'chirpstack' else uplink) + '\n')
+    for event in simulator.events:
+        print(f"{event[3]} at {event[0]:.0f} s: {event[1]} / {event[2]}", file=sys.stderr)
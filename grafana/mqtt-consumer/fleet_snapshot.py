@@ -0,0 +1,197 @@
+from multiprocessing import shared_memory
+import threading
+import numpy as np
+
+from track_store import DEVICE_ID_MAX_BYTES, encode_device_id
+
+# Predicted positions of an error zone by default
+ZONE_STEPS = 3
+
+'''
+Points of the ring of a predicted error zone of 'steps' predicted positions (last point + 2 sides of 'steps' points)
+'''
+def zone_ring_points(steps):
+    return 1 + 2 * steps
+
+'''
+One record by device, 'sequence' is the seqlock of the record (odd while the record is being written)
+
+The ring of the error zone has 'zone_points' points, padded with nan
+'''
+def record_dtype(zone_points):
+    return np.dtype([
+        ('sequence', np.uint64),
+        ('device_id', f'S{DEVICE_ID_MAX_BYTES}'),
+        ('date', np.float64),
+        ('latitude', np.float64),
+        ('longitude', np.float64),
+        ('speed', np.float64),
+        ('v_east', np.float64),
+        ('v_north', np.float64),
+        # predicted bounding box (min_lon, min_lat, max_lon, max_lat) and ring (lon, lat) of the error zone
+        ('bbox', np.float64, (4,)),
+        ('zone', np.float64, (zone_points, 2)),
+    ])
+
+# The header holds the capacity and the size of the rings (a shared counter would need a lock between the writing processes)
+HEADER_DTYPE = np.dtype([('capacity', np.uint64), ('zone_points', np.uint64)])
+
+#############################################################################################
+#                                  SHARED FLEET SNAPSHOT                                    #
+#############################################################################################
+
+'''
+Last fix, velocity and predicted error zone of every device, in a shared memory block
+
+The records are a NumPy structured array (record_dtype) mapped on the shared memory, so all
+processes read the same live view of the fleet without any pickling. Each record has its own
+seqlock: a writer makes its sequence odd, writes the record and makes it even again, a reader
+copies the records and retries the ones whose sequence was odd or changed during the copy.
+Each record has a single writer (the process owning the device, its threads serialized by FleetSnapshotWriter).
+The size of the rings of the error zones is given at the creation ('zone_steps' predicted positions)
+and read from the header by the other processes
+'''
+class SharedFleetSnapshot:
+    def __init__(self, name=None, capacity=1000, create=False, zone_steps=ZONE_STEPS):
+        if create:
+            size = HEADER_DTYPE.itemsize + capacity * record_dtype(zone_ring_points(zone_steps)).itemsize
+            self._memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+        self.name = self._memory.name
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self._memory.buf)
+        if create:
+            self.header['capacity'] = capacity
+            self.header['zone_points'] = zone_ring_points(zone_steps)
+        self.capacity = int(self.header['capacity'])
+        self.zone_points = int(self.header['zone_points'])
+        self.dtype = record_dtype(self.zone_points)
+        self.records = np.ndarray((self.capacity,), dtype=self.dtype, buffer=self._memory.buf, offset=HEADER_DTYPE.itemsize)
+        if create:
+            self.records[:] = np.zeros(1, dtype=self.dtype)
+
+    '''
+    Write the record of 'slot' ('zone' is a (n, 2) ring of (lon, lat), or None if there is no prediction)
+
+    Raise ValueError if the ring has more points than the rings of the snapshot, or if the device id is too long
+    '''
+    def write(self, slot, device_id, date, latitude, longitude, speed, v_east, v_north, zone=None):
+        if zone is not None and len(zone) > self.zone_points:
+            raise ValueError(f"Error zone of {len(zone)} points, the fleet snapshot holds {self.zone_points} points")
+        encoded_id = encode_device_id(device_id)
+        record = self.records[slot:slot + 1]
+        sequence = int(record['sequence'][0])
+        record['sequence'] = sequence + 1
+        record['device_id'] = encoded_id
+        record['date'] = date
+        record['latitude'] = latitude
+        record['longitude'] = longitude
+        record['speed'] = speed
+        record['v_east'] = v_east
+        record['v_north'] = v_north
+        ring = np.full((self.zone_points, 2), np.nan)
+        if zone is not None and len(zone) > 0:
+            zone = np.asarray(zone, dtype=np.float64)
+            ring[:len(zone)] = zone
+            record['bbox'] = (zone[:, 0].min(), zone[:, 1].min(), zone[:, 0].max(), zone[:, 1].max())
+        else:
+            record['bbox'] = np.nan
+        record['zone'] = ring
+        record['sequence'] = sequence + 2
+
+    '''
+    Mark the record of 'slot' as empty
+    '''
+    def clear(self, slot):
+        record = self.records[slot:slot + 1]
+        sequence = int(record['sequence'][0])
+        record['sequence'] = sequence + 1
+        record['device_id'] = b''
+        record['sequence'] = sequence + 2
+
+    '''
+    Consistent copy of the used records (one copy of the array, and a new copy of the records written meanwhile)
+
+    The records still being written after 'retries' copies are left out of the copy
+    '''
+    def read(self, retries=10):
+        records = self.records.copy()
+        for _ in range(retries):
+            torn = self._torn(records)
+            if not torn.any():
+                break
+            records[torn] = self.records[torn]
+        return records[~self._torn(records) & (records['device_id'] != b'')]
+
+    def _torn(self, records):
+        # written during the copy, or being written when copied
+        return (records['sequence'] % 2 == 1) | (records['sequence'] != self.records['sequence'])
+
+    def close(self):
+        # the arrays must be released before the shared memory
+        self.header = None
+        self.records = None
+        self._memory.close()
+
+    def unlink(self):
+        self._memory.unlink()
+
+'''
+Writer of the records of the devices of one process, in its own range of slots [first_slot, first_slot + slots)
+
+The writer is shared by the threads of the process: its lock keeps a single writer by record. When there is no
+free slot left, the records older than 'window_seconds' before the fix being written are freed
+'''
+class FleetSnapshotWriter:
+    def __init__(self, snapshot, first_slot, slots, window_seconds=None):
+        self.snapshot = snapshot
+        self.first_slot = first_slot
+        self.slots = slots
+        self.window_seconds = window_seconds
+        # device_id -> slot, date of the record
+        self._slots = {}
+        self._dates = {}
+        self._free = list(range(first_slot + slots - 1, first_slot - 1, -1))
+        self._lock = threading.Lock()
+
+    '''
+    Write the record of a device, return False if there is no free slot for it
+
+    A fix older than the record of the device (processed late by another thread) is not written
+    '''
+    def publish(self, device_id, date, latitude, longitude, speed, v_east, v_north, zone=None):
+        # no slot is taken by a device id which can not be written
+        encode_device_id(device_id)
+        with self._lock:
+            slot = self._slots.get(device_id)
+            if slot is None:
+                if len(self._free) == 0 and self.window_seconds is not None:
+                    self._expire(date - self.window_seconds)
+                if len(self._free) == 0:
+                    return False
+                slot = self._free.pop()
+                self._slots[device_id] = slot
+            elif date < self._dates[device_id]:
+                return True
+            self.snapshot.write(slot, device_id, date, latitude, longitude, speed, v_east, v_north, zone)
+            self._dates[device_id] = date
+            return True
+
+    '''
+    Free the slots of the devices whose record is older than 'oldest_date', return the number of slots freed
+    '''
+    def expire(self, oldest_date):
+        with self._lock:
+            return self._expire(oldest_date)
+
+    def _expire(self, oldest_date):
+        expired = [device_id for device_id, date in self._dates.items() if date < oldest_date]
+        for device_id in expired:
+            slot = self._slots.pop(device_id)
+            del self._dates[device_id]
+            self.snapshot.clear(slot)
+            self._free.append(slot)
+        return len(expired)
+
+    def __contains__(self, device_id):
+        return device_id in self._slots
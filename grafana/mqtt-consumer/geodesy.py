@@ -0,0 +1,77 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+#############################################################################################
+#                                        GEODESY                                            #
+#############################################################################################
+# All functions take latitudes and longitudes in degrees, in this order (lat, lon), as
+# scalars or NumPy arrays (broadcasted together). Distances are in kilometers and
+# bearings in radians, clockwise from the north.
+
+'''
+Calculate distance from 2 points in kilometers (haversine formula)
+'''
+def haversine_distance(lat1, lon1, lat2, lon2):
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlat = lat2 - lat1
+    dlon = np.radians(np.subtract(lon2, lon1))
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    # rounding errors can give 'a' slightly above 1 for antipodal points
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+'''
+Calculate distance from 2 points in meters
+'''
+def haversine_distance_in_meters(lat1, lon1, lat2, lon2):
+    return haversine_distance(lat1, lon1, lat2, lon2) * 1000
+
+'''
+Initial bearing to go from point 1 to point 2 (great circle)
+'''
+def initial_bearing(lat1, lon1, lat2, lon2):
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlon = np.radians(np.subtract(lon2, lon1))
+    y = np.sin(dlon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return np.arctan2(y, x)
+
+'''
+Calculate point from a point, a distance (km) and a bearing
+
+Return (latitude, longitude)
+'''
+def destination_point(lat, lon, distance, bearing):
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+    angular_distance = np.divide(distance, EARTH_RADIUS_KM)
+    lat2 = np.arcsin(np.sin(lat) * np.cos(angular_distance) + np.cos(lat) * np.sin(angular_distance) * np.cos(bearing))
+    lon2 = lon + np.arctan2(np.sin(bearing) * np.sin(angular_distance) * np.cos(lat), np.cos(angular_distance) - np.sin(lat) * np.sin(lat2))
+    return np.degrees(lat2), np.degrees(lon2)
+
+'''
+Calculate the 2 points at 'distance' (km) of point 2, perpendicular to the segment from point 1 to point 2
+
+Return ((latitude, longitude) on the right, (latitude, longitude) on the left)
+'''
+def perpendicular_points(lat1, lon1, lat2, lon2, distance):
+    bearing = initial_bearing(lat1, lon1, lat2, lon2)
+    return destination_point(lat2, lon2, distance, bearing + np.pi / 2), destination_point(lat2, lon2, distance, bearing - np.pi / 2)
+
+'''
+Distances (km) between all points of A and all points of B, as a (len(A), len(B)) matrix
+'''
+def cross_distance_matrix(latitudes_a, longitudes_a, latitudes_b, longitudes_b):
+    latitudes_a = np.asarray(latitudes_a, dtype=np.float64)
+    longitudes_a = np.asarray(longitudes_a, dtype=np.float64)
+    latitudes_b = np.asarray(latitudes_b, dtype=np.float64)
+    longitudes_b = np.asarray(longitudes_b, dtype=np.float64)
+    return haversine_distance(latitudes_a[:, None], longitudes_a[:, None], latitudes_b[None, :], longitudes_b[None, :])
+
+'''
+Distances (km) between all pairs of points, as a symmetric (n, n) matrix
+'''
+def pairwise_distance_matrix(latitudes, longitudes):
+    return cross_distance_matrix(latitudes, longitudes, latitudes, longitudes)
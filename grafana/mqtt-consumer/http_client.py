@@ -0,0 +1,46 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import time
+import requests
+
+# (connect, read) timeouts in seconds by target
+DEFAULT_TIMEOUTS = {
+    'prometheus': (2, 5),
+    'pushgateway': (2, 5),
+    'nginx': (2, 10),
+}
+
+#############################################################################################
+#                                       HTTP CLIENT                                         #
+#############################################################################################
+
+'''
+Shared HTTP client of the consumer (Prometheus, Pushgateway, nginx)
+
+A single session keeps the connections open between the requests, each target has
+its own timeouts, and failed requests are retried a bounded number of times with backoff
+'''
+class HttpClient:
+    def __init__(self, timeouts=None, retries=2, backoff=0.2, pool_size=10, latency_metric=None):
+        self.timeouts = dict(DEFAULT_TIMEOUTS if timeouts is None else timeouts)
+        self.latency_metric = latency_metric
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    '''
+    Send a request to 'target' ('prometheus', 'pushgateway', 'nginx'), its duration is observed in the latency metric
+    '''
+    def request(self, target, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeouts.get(target, (2, 10)))
+        start = time.perf_counter()
+        try:
+            return self.session.request(method, url, **kwargs)
+        finally:
+            if self.latency_metric is not None:
+                self.latency_metric.labels(target=target).observe(time.perf_counter() - start)
+
+    def get(self, target, url, **kwargs):
+        return self.request(target, 'GET', url, **kwargs)
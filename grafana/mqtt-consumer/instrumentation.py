@@ -0,0 +1,144 @@
+from collections import Counter as StackCounter
+from prometheus_client import Counter, Gauge, Histogram
+import functools
+import os
+import sys
+import threading
+import time
+
+#############################################################################################
+#                                       STAGE TIMER                                         #
+#############################################################################################
+
+'''
+Duration, in-flight count and errors of the stages of the processing of a message, in a Prometheus registry
+
+Functions are decorated with timed('stage'). When the timer is disabled the functions are returned
+as they are, so the instrumentation costs nothing. With a StackSampler, the stacks of the stages
+slower than its threshold are written for flame graphs
+'''
+class StageTimer:
+    def __init__(self, registry, enabled=True, sampler=None):
+        self.enabled = enabled
+        self.sampler = sampler
+        if not enabled:
+            return
+        self.duration_metric = Histogram('consumer_stage_duration_seconds', 'Duration of the stages of the processing of a message', ['stage'], registry=registry)
+        self.in_flight_metric = Gauge('consumer_stage_in_flight', 'Stages being executed', ['stage'], registry=registry)
+        self.errors_metric = Counter('consumer_stage_errors', 'Exceptions raised by the stages', ['stage'], registry=registry)
+
+    '''
+    Decorator timing the function as the stage 'stage'
+    '''
+    def timed(self, stage):
+        def decorator(function):
+            if not self.enabled:
+                return function
+            # labelled children resolved once, not at each call
+            duration = self.duration_metric.labels(stage=stage)
+            in_flight = self.in_flight_metric.labels(stage=stage)
+            errors = self.errors_metric.labels(stage=stage)
+
+            @functools.wraps(function)
+            def timed_function(*args, **kwargs):
+                in_flight.inc()
+                record = self.sampler.enter(stage) if self.sampler is not None else None
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                except Exception:
+                    errors.inc()
+                    raise
+                finally:
+                    elapsed = time.perf_counter() - start
+                    duration.observe(elapsed)
+                    in_flight.dec()
+                    if record is not None:
+                        self.sampler.exit(record, elapsed)
+            return timed_function
+        return decorator
+
+#############################################################################################
+#                                      STACK SAMPLER                                        #
+#############################################################################################
+
+'''
+Sampling profiler of the stages: every 'interval' seconds, the stacks of the threads inside a stage are recorded
+
+When a stage lasts more than 'threshold' seconds, its samples are written in 'directory' in the collapsed
+format ('frame;frame;frame count' by line), read by flamegraph.pl, speedscope or inferno
+'''
+class StackSampler:
+    def __init__(self, threshold, interval=0.005, directory='profiles'):
+        self.threshold = threshold
+        self.interval = interval
+        self.directory = directory
+        # thread ident -> stages in progress on the thread (outermost first)
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='stack-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    '''
+    A stage starts on the current thread, return its record for exit()
+    '''
+    def enter(self, stage):
+        record = {'stage': stage, 'samples': StackCounter()}
+        with self._lock:
+            self._active.setdefault(threading.get_ident(), []).append(record)
+        return record
+
+    '''
+    A stage ends, its samples are written if it was too slow
+    '''
+    def exit(self, record, elapsed):
+        with self._lock:
+            records = [active for active in self._active.get(threading.get_ident(), []) if active is not record]
+            self._active[threading.get_ident()] = records
+            if len(records) == 0:
+                self._active.pop(threading.get_ident(), None)
+        if elapsed >= self.threshold and len(record['samples']) > 0:
+            self._dump(record, elapsed)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if len(self._active) == 0:
+                    continue
+                frames = sys._current_frames()
+                for ident, records in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stack = collapse_stack(frame)
+                    for record in records:
+                        record['samples'][stack] += 1
+
+    def _dump(self, record, elapsed):
+        file_name = os.path.join(self.directory, f"{record['stage']}-{int(time.time() * 1000)}-{threading.get_ident()}.folded")
+        try:
+            with open(file_name, 'w') as file:
+                for stack, count in record['samples'].items():
+                    file.write(f"{record['stage']};{stack} {count}\n")
+            print(f"Stage {record['stage']} took {elapsed * 1000:.1f} ms, stacks written in {file_name}")
+        except OSError as e:
+            print(f"Failed to write the stacks of stage {record['stage']}: {e}")
+
+'''
+Stack of a frame as 'function (file);...', outermost call first
+'''
+def collapse_stack(frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
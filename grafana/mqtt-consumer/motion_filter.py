@@ -0,0 +1,171 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from geodesy import EARTH_RADIUS_KM
+
+EARTH_RADIUS_M = EARTH_RADIUS_KM * 1000
+
+#############################################################################################
+#                                       KALMAN FILTER                                       #
+#############################################################################################
+
+'''
+Constant velocity Kalman filter of a device, updated in O(1) for each new fix
+
+The state is (east, north, v_east, v_north) in meters and m/s, in a local projection centered on
+the first fix of the device, with its covariance. 'measurement_noise' is the standard deviation of
+the GPS positions (m) and 'process_noise' the standard deviation of the accelerations (m/s²)
+'''
+class KalmanTrack:
+    __slots__ = ('lat0', 'lon0', 'scale_east', 'date', 'state', 'covariance', 'measurement_noise', 'process_noise', 'updates')
+
+    def __init__(self, date, latitude, longitude, measurement_noise=10.0, process_noise=0.1, initial_speed_std=5.0):
+        self.lat0 = latitude
+        self.lon0 = longitude
+        self.scale_east = EARTH_RADIUS_M * np.cos(np.radians(latitude))
+        self.date = date
+        self.state = np.zeros(4)
+        self.covariance = np.diag([measurement_noise**2, measurement_noise**2, initial_speed_std**2, initial_speed_std**2])
+        self.measurement_noise = measurement_noise
+        self.process_noise = process_noise
+        self.updates = 1
+
+    '''
+    Add a fix (predict up to its date, then correct with its position), older fixes are ignored
+
+    Return True if the fix was used
+    '''
+    def update(self, date, latitude, longitude):
+        if date <= self.date:
+            return False
+        state, covariance = self._predict(date - self.date)
+        measured = np.array(self._to_local(latitude, longitude))
+
+        # only the position is measured: H = [I 0]
+        innovation = measured - state[:2]
+        S = covariance[:2, :2] + np.eye(2) * self.measurement_noise**2
+        K = covariance[:, :2] @ np.linalg.inv(S)
+        self.state = state + K @ innovation
+        self.covariance = covariance - K @ covariance[:2, :]
+        self.date = date
+        self.updates += 1
+        return True
+
+    '''
+    Predicted positions at 'dates' (after the last fix)
+
+    Return (latitudes, longitudes, standard deviations of the positions in meters)
+    '''
+    def predict(self, dates):
+        dates = np.atleast_1d(np.asarray(dates, dtype=np.float64))
+        latitudes = np.empty(len(dates))
+        longitudes = np.empty(len(dates))
+        deviations = np.empty(len(dates))
+        for index, date in enumerate(dates):
+            state, covariance = self._predict(max(date - self.date, 0.0))
+            latitudes[index], longitudes[index] = self._to_geographic(state[0], state[1])
+            deviations[index] = np.sqrt(max(covariance[0, 0], covariance[1, 1]))
+        return latitudes, longitudes, deviations
+
+    '''
+    Filtered velocity (v_east, v_north) in m/s
+    '''
+    def velocity(self):
+        return self.state[2], self.state[3]
+
+    '''
+    Filtered speed (m/s) and its standard deviation
+    '''
+    def speed(self):
+        v_east, v_north = self.state[2], self.state[3]
+        speed = np.hypot(v_east, v_north)
+        if speed == 0:
+            return 0.0, np.sqrt(max(self.covariance[2, 2], self.covariance[3, 3]))
+        # variance of the speed along the direction of the velocity
+        direction = np.array([v_east, v_north]) / speed
+        return float(speed), float(np.sqrt(direction @ self.covariance[2:, 2:] @ direction))
+
+    '''
+    The device is moving if its speed is above 'min_speed' (m/s) and significantly above its uncertainty
+    '''
+    def is_moving(self, min_speed=0.5, sigmas=2.0):
+        speed, deviation = self.speed()
+        return speed > min_speed and speed > sigmas * deviation
+
+    '''
+    Independent copy of the filter (its state can be read while the original is updated)
+    '''
+    def copy(self):
+        track = KalmanTrack.__new__(KalmanTrack)
+        for name in KalmanTrack.__slots__:
+            setattr(track, name, getattr(self, name))
+        track.state = self.state.copy()
+        track.covariance = self.covariance.copy()
+        return track
+
+    def _predict(self, dt):
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        # white noise acceleration model
+        q = self.process_noise**2
+        Q = np.zeros((4, 4))
+        Q[0, 0] = Q[1, 1] = q * dt**4 / 4
+        Q[0, 2] = Q[2, 0] = Q[1, 3] = Q[3, 1] = q * dt**3 / 2
+        Q[2, 2] = Q[3, 3] = q * dt**2
+        return F @ self.state, F @ self.covariance @ F.T + Q
+
+    def _to_local(self, latitude, longitude):
+        return np.radians(longitude - self.lon0) * self.scale_east, np.radians(latitude - self.lat0) * EARTH_RADIUS_M
+
+    def _to_geographic(self, east, north):
+        return self.lat0 + np.degrees(north / EARTH_RADIUS_M), self.lon0 + np.degrees(east / self.scale_east)
+
+#############################################################################################
+#                                        FILTER BANK                                        #
+#############################################################################################
+
+'''
+Kalman filter (KalmanTrack) of each device, fed with the same fixes as the track store
+'''
+class FilterBank:
+    def __init__(self, max_devices=1000, measurement_noise=10.0, process_noise=0.1):
+        self.max_devices = max_devices
+        self.measurement_noise = measurement_noise
+        self.process_noise = process_noise
+        # device_id -> KalmanTrack
+        self._filters = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    Add a fix to the filter of 'device_id' (created on its first fix)
+
+    Return True if the fix was used
+    '''
+    def update(self, device_id, date, latitude, longitude):
+        date, latitude, longitude = float(date), float(latitude), float(longitude)
+        with self._lock:
+            track = self._filters.get(device_id)
+            if track is None:
+                self._filters[device_id] = KalmanTrack(date, latitude, longitude, self.measurement_noise, self.process_noise)
+                used = True
+            else:
+                used = track.update(date, latitude, longitude)
+            self._filters.move_to_end(device_id)
+
+            # forget the devices which have not reported for the longest time
+            while len(self._filters) > self.max_devices:
+                self._filters.popitem(last=False)
+        return used
+
+    '''
+    Return a copy of the filter of 'device_id', or None if the device is unknown
+    '''
+    def get(self, device_id):
+        with self._lock:
+            track = self._filters.get(device_id)
+            return None if track is None else track.copy()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._filters)
@@ -0,0 +1,218 @@
+import queue
+import threading
+import time
+import zlib
+
+POLICIES = ['block', 'drop_newest', 'drop_oldest']
+
+'''
+Stable partition of a device (same result in every process, unlike hash())
+'''
+def device_partition(device_id, partitions):
+    return zlib.crc32(str(device_id).encode()) % partitions
+
+#############################################################################################
+#                                     INGEST PIPELINE                                       #
+#############################################################################################
+
+'''
+Bounded queues between the MQTT callback and a pool of worker threads
+
+Messages of a same device always go to the same worker, so they are processed in order.
+When the queue of a worker is full, the policy decides what happens:
+ - 'block': the MQTT callback waits (backpressure on the broker)
+ - 'drop_newest': the incoming message is dropped
+ - 'drop_oldest': the oldest waiting message of the worker is dropped
+'''
+class IngestPipeline:
+    def __init__(self, handler, workers=4, max_queue=1000, policy='drop_oldest', latency_metric=None, dropped_metric=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy {policy}, expected one of {POLICIES}")
+        self.handler = handler
+        self.policy = policy
+        self.latency_metric = latency_metric
+        self.dropped_metric = dropped_metric
+        self._queues = [queue.Queue(maxsize=max_queue) for _ in range(workers)]
+        self._threads = []
+        self._put_lock = threading.Lock()
+
+    '''
+    Start the worker threads, until then the messages are processed in the caller thread
+    '''
+    def start(self):
+        if len(self._threads) > 0:
+            return
+        for index, worker_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(worker_queue,), name=f'ingest-worker-{index}')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    '''
+    Queue the message 'args' of the device 'key' for the handler
+
+    Return False if a message was dropped
+    '''
+    def submit(self, key, *args):
+        item = (time.time(), args)
+        if len(self._threads) == 0:
+            self._process(item)
+            return True
+
+        worker_queue = self._queues[device_partition(key, len(self._queues))]
+        if self.policy == 'block':
+            worker_queue.put(item)
+            return True
+        try:
+            worker_queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+
+        self._dropped()
+        if self.policy == 'drop_newest':
+            return False
+        with self._put_lock:
+            while True:
+                try:
+                    worker_queue.get_nowait()
+                    worker_queue.task_done()
+                except queue.Empty:
+                    pass
+                try:
+                    worker_queue.put_nowait(item)
+                    return False
+                except queue.Full:
+                    self._dropped()
+
+    '''
+    Number of messages waiting in the queues
+    '''
+    def depth(self):
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    '''
+    Wait until all queued messages are processed
+    '''
+    def join(self):
+        for worker_queue in self._queues:
+            worker_queue.join()
+
+    def _run(self, worker_queue):
+        while True:
+            item = worker_queue.get()
+            try:
+                self._process(item)
+            finally:
+                worker_queue.task_done()
+
+    def _process(self, item):
+        queued_at, args = item
+        started_at = time.time()
+        try:
+            self.handler(*args)
+        except Exception as e:
+            print(f"Failed to process message: {e}")
+        if self.latency_metric is not None:
+            self.latency_metric.labels(stage='wait').observe(started_at - queued_at)
+            self.latency_metric.labels(stage='process').observe(time.time() - started_at)
+
+    def _dropped(self):
+        if self.dropped_metric is not None:
+            self.dropped_metric.inc()
+
+#############################################################################################
+#                                       MICRO-BATCH                                         #
+#############################################################################################
+
+'''
+Collect the messages received during 'window' seconds and give them to the handler at once
+
+The handler receives the list of the messages ('args' of submit), in their arrival order.
+A batch is closed 'window' seconds after its first message, or as soon as it holds 'max_batch' messages
+'''
+class MicroBatcher:
+    def __init__(self, handler, window=0.25, max_batch=1000, batch_size_metric=None, latency_metric=None):
+        self.handler = handler
+        self.window = window
+        self.max_batch = max_batch
+        self.batch_size_metric = batch_size_metric
+        self.latency_metric = latency_metric
+        # (queued_at, args) of the messages of the next batch
+        self._pending = []
+        self._processing = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    '''
+    Start the batching thread, until then each message is processed alone in the caller thread
+    '''
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='micro-batch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    '''
+    Add the message 'args' to the current batch ('key' is only there to be used like IngestPipeline)
+    '''
+    def submit(self, key, *args):
+        item = (time.time(), args)
+        if self._thread is None:
+            self._process([item])
+            return True
+        with self._condition:
+            self._pending.append(item)
+            if len(self._pending) == 1 or len(self._pending) >= self.max_batch:
+                self._condition.notify_all()
+        return True
+
+    '''
+    Number of messages waiting for the next batch
+    '''
+    def depth(self):
+        with self._condition:
+            return len(self._pending)
+
+    '''
+    Wait until all submitted messages are processed
+    '''
+    def join(self):
+        with self._condition:
+            while len(self._pending) > 0 or self._processing:
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while len(self._pending) == 0:
+                    self._condition.wait()
+                # the batch is closed 'window' seconds after its first message
+                closing_at = self._pending[0][0] + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = closing_at - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                self._pending = self._pending[self.max_batch:]
+                self._processing = True
+            try:
+                self._process(batch)
+            finally:
+                with self._condition:
+                    self._processing = False
+                    self._condition.notify_all()
+
+    def _process(self, batch):
+        try:
+            self.handler([args for _, args in batch])
+        except Exception as e:
+            print(f"Failed to process batch: {e}")
+        done_at = time.time()
+        if self.batch_size_metric is not None:
+            self.batch_size_metric.observe(len(batch))
+        if self.latency_metric is not None:
+            for queued_at, _ in batch:
+                self.latency_metric.observe(done_at - queued_at)
@@ -0,0 +1,109 @@
+from prometheus_client import push_to_gateway, start_http_server
+import threading
+
+from http_client import HttpClient
+
+MODES = ['push', 'scrape']
+
+#############################################################################################
+#                                    METRICS PUBLISHER                                      #
+#############################################################################################
+
+'''
+Publish the metrics of the registry, coalescing the updates of many messages
+
+ - 'push': the registry is pushed to the Pushgateway every 'interval' seconds, or as soon as
+   'max_pending' updates are waiting, through the shared HTTP client
+ - 'scrape': the registry is exposed on http://0.0.0.0:'port'/metrics for Prometheus
+
+'timer' is an optional decorator applied to each push (e.g. StageTimer.timed('push'))
+'''
+class MetricsPublisher:
+    def __init__(self, registry, gateway, job, mode='push', interval=5, max_pending=200, port=8000, http_client=None, grouping_key=None, timer=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown metrics mode {mode}, expected one of {MODES}")
+        self.registry = registry
+        self.gateway = gateway
+        self.job = job
+        self.mode = mode
+        self.interval = interval
+        self.max_pending = max_pending
+        self.port = port
+        # labels added to the group of the metrics on the Pushgateway (e.g. the shard of the consumer)
+        self.grouping_key = grouping_key
+        self.http = HttpClient() if http_client is None else http_client
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._started = False
+        self._push = self._push_registry if timer is None else timer(self._push_registry)
+
+    '''
+    Start the flush thread (push mode) or the HTTP server (scrape mode)
+
+    Until then, each update is pushed immediately
+    '''
+    def start(self):
+        if self._started:
+            return
+        self._started = True
+        if self.mode == 'scrape':
+            start_http_server(self.port, registry=self.registry)
+            print(f"Metrics exposed on port {self.port}")
+            return
+        thread = threading.Thread(target=self._run, name='metrics-publisher')
+        thread.daemon = True
+        thread.start()
+
+    '''
+    Notify that the metrics of the registry have been updated
+    '''
+    def mark_dirty(self):
+        if self.mode == 'scrape':
+            return
+        if not self._started:
+            self.flush()
+            return
+        with self._lock:
+            self._pending += 1
+            pending = self._pending
+        if pending >= self.max_pending:
+            self._flush_event.set()
+
+    '''
+    Push the registry to the Pushgateway
+
+    The pending updates are only cleared once pushed, a failed push is retried by the next flush
+    '''
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+        self._push()
+        with self._lock:
+            # the updates made during the push are still pending
+            self._pending -= pending
+
+    def _push_registry(self):
+        push_to_gateway(self.gateway, job=self.job, registry=self.registry, grouping_key=self.grouping_key, handler=self._session_handler)
+
+    def _run(self):
+        while True:
+            self._flush_event.wait(self.interval)
+            self._flush_event.clear()
+            with self._lock:
+                pending = self._pending
+            if pending == 0:
+                continue
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to push metrics to Pushgateway: {e}")
+
+    '''
+    Handler of push_to_gateway reusing the connections of the HTTP client
+    '''
+    def _session_handler(self, url, method, timeout, headers, data):
+        def handle():
+            res = self.http.request('pushgateway', method, url, data=data, headers=dict(headers))
+            res.raise_for_status()
+        return handle
@@ -0,0 +1,136 @@
+import multiprocessing
+import queue
+import threading
+
+from pipeline import device_partition
+
+#############################################################################################
+#                                    SHARD COORDINATOR                                      #
+#############################################################################################
+
+'''
+Run the consumer in 'shards' worker processes, each one owning the devices of its partition
+
+The main process only receives the MQTT messages and dispatches the raw payloads to the worker
+of the device (device_partition of its key, the device id). The fixes stored by each worker are sent back to
+the coordinator, which forwards them to the other workers: every worker keeps a view of the
+whole fleet for the collision checks, but only processes and publishes its own devices.
+
+'target' is called in each worker process as target(index, shards, inbox, fixes, remote_fixes, *args)
+
+The queues of the fixes hold at most 'max_fixes' fixes: when a worker stalls, the fixes for it are
+dropped (counted by 'dropped_fixes_metric') instead of piling up in the coordinator
+'''
+class ShardCoordinator:
+    def __init__(self, shards, target, max_queue=1000, dropped_metric=None, args=(), max_fixes=10000, dropped_fixes_metric=None):
+        self.shards = shards
+        self.dropped_metric = dropped_metric
+        self.dropped_fixes_metric = dropped_fixes_metric
+        # 'spawn': the workers start from a clean interpreter, without the threads of the main process
+        context = multiprocessing.get_context('spawn')
+        self._inboxes = [context.Queue(max_queue) for _ in range(shards)]
+        self._remote_fixes = [context.Queue(max_fixes) for _ in range(shards)]
+        self._fixes = context.Queue(max_fixes)
+        self._processes = [
+            context.Process(target=target, args=(index, shards, self._inboxes[index], self._fixes, self._remote_fixes[index]) + tuple(args), name=f'consumer-shard-{index}', daemon=True)
+            for index in range(shards)
+        ]
+        self._thread = None
+
+    '''
+    Start the worker processes and the forwarding of the fixes between them
+    '''
+    def start(self):
+        if self._thread is not None:
+            return
+        for process in self._processes:
+            process.start()
+        self._thread = threading.Thread(target=self._forward_fixes, name='shard-coordinator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    '''
+    Send a message to the worker of the device 'key'
+
+    Return False if the queue of the worker is full (the message is dropped)
+    '''
+    def dispatch(self, key, *args):
+        try:
+            self._inboxes[device_partition(key, self.shards)].put_nowait(args)
+            return True
+        except queue.Full:
+            if self.dropped_metric is not None:
+                self.dropped_metric.inc()
+            return False
+
+    '''
+    Processes of the workers still running
+    '''
+    def alive(self):
+        return [process for process in self._processes if process.is_alive()]
+
+    def _forward_fixes(self):
+        while True:
+            index, fix = self._fixes.get()
+            for other, remote_fixes in enumerate(self._remote_fixes):
+                if other == index:
+                    continue
+                try:
+                    remote_fixes.put_nowait(fix)
+                except queue.Full:
+                    if self.dropped_fixes_metric is not None:
+                        self.dropped_fixes_metric.inc()
+
+#############################################################################################
+#                                        SHARD LINK                                         #
+#############################################################################################
+
+'''
+Worker side of the coordinator: sends the fixes of the devices of the shard, and applies the fixes
+of the devices of the other shards with 'apply' (a thread started by start())
+
+With 'forward' False, the fixes are not sent (the shards share their fleet in another way).
+A fix is dropped (counted by 'dropped_metric') if the queue to the coordinator is full
+'''
+class ShardLink:
+    def __init__(self, index, shards, fixes, remote_fixes, forward=True, dropped_metric=None):
+        self.index = index
+        self.shards = shards
+        self.forward = forward
+        self.dropped_metric = dropped_metric
+        self._fixes = fixes
+        self._remote_fixes = remote_fixes
+        self._thread = None
+
+    def start(self, apply):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(apply,), name=f'shard-link-{self.index}')
+        self._thread.daemon = True
+        self._thread.start()
+
+    '''
+    Send a fix (device_id, date, latitude, longitude, speed) of a device of this shard to the other shards
+    '''
+    def publish(self, fix):
+        if not self.forward:
+            return
+        try:
+            self._fixes.put_nowait((self.index, fix))
+        except queue.Full:
+            if self.dropped_metric is not None:
+                self.dropped_metric.inc()
+
+    '''
+    Return True if the device is processed by this shard (same partition as ShardCoordinator.dispatch)
+    '''
+    def owns(self, device_id):
+        return device_partition(device_id, self.shards) == self.index
+
+    def _run(self, apply):
+        while True:
+            fix = self._remote_fixes.get()
+            try:
+                apply(*fix)
+            except Exception as e:
+                print(f"Failed to apply fix from another shard: {e}")
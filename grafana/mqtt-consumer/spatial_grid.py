@@ -0,0 +1,115 @@
+import math
+from collections import defaultdict
+
+# Boxes covering more cells than this are not put in the cells (absurd predictions can cover the whole map)
+MAX_CELLS_PER_BOX = 256
+
+#############################################################################################
+#                                      SPATIAL GRID                                         #
+#############################################################################################
+
+'''
+Uniform grid of buckets over bounding boxes (min_x, min_y, max_x, max_y)
+
+Broad phase of the collision detection: only the boxes sharing a cell of the
+grid, and whose bounding boxes overlap, are given to the exact polygon tests.
+Boxes larger than 'max_cells' cells are kept aside and compared with every box
+'''
+class SpatialGrid:
+    def __init__(self, cell_size, max_cells=MAX_CELLS_PER_BOX):
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        # (column, row) -> set of keys
+        self._cells = defaultdict(set)
+        # key -> bounds
+        self._bounds = {}
+        # keys of the boxes too large for the cells
+        self._oversized = set()
+
+    '''
+    Add or move the box 'key' in the grid
+    '''
+    def insert(self, key, bounds):
+        if key in self._bounds:
+            self.remove(key)
+        self._bounds[key] = tuple(bounds)
+        if self._cell_count(bounds) > self.max_cells:
+            self._oversized.add(key)
+            return
+        for cell in self._cells_of(bounds):
+            self._cells[cell].add(key)
+
+    def remove(self, key):
+        bounds = self._bounds.pop(key, None)
+        if bounds is None:
+            return
+        if key in self._oversized:
+            self._oversized.discard(key)
+            return
+        for cell in self._cells_of(bounds):
+            keys = self._cells.get(cell)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._cells[cell]
+
+    '''
+    Return the keys of the boxes overlapping 'bounds'
+    '''
+    def query(self, bounds):
+        found = {key for key in self._oversized if boxes_overlap(bounds, self._bounds[key])}
+        if self._cell_count(bounds) > self.max_cells:
+            # as many tests as boxes, instead of a huge number of cells
+            return found | {key for key in self._bounds if boxes_overlap(bounds, self._bounds[key])}
+        for cell in self._cells_of(bounds):
+            for key in self._cells.get(cell, ()):
+                if key not in found and boxes_overlap(bounds, self._bounds[key]):
+                    found.add(key)
+        return found
+
+    '''
+    Return all pairs (key_a, key_b) of overlapping boxes, each pair once
+    '''
+    def candidate_pairs(self):
+        pairs = set()
+        for keys in self._cells.values():
+            if len(keys) < 2:
+                continue
+            keys = sorted(keys, key=str)
+            for i in range(len(keys)):
+                for j in range(i + 1, len(keys)):
+                    pair = (keys[i], keys[j])
+                    if pair not in pairs and boxes_overlap(self._bounds[keys[i]], self._bounds[keys[j]]):
+                        pairs.add(pair)
+        for oversized in self._oversized:
+            for key, bounds in self._bounds.items():
+                if key != oversized and boxes_overlap(self._bounds[oversized], bounds):
+                    pairs.add(tuple(sorted((oversized, key), key=str)))
+        return pairs
+
+    def __contains__(self, key):
+        return key in self._bounds
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def _cell_count(self, bounds):
+        if not all(math.isfinite(value) for value in bounds):
+            return math.inf
+        min_x, min_y, max_x, max_y = bounds
+        columns = math.floor(max_x / self.cell_size) - math.floor(min_x / self.cell_size) + 1
+        rows = math.floor(max_y / self.cell_size) - math.floor(min_y / self.cell_size) + 1
+        return columns * rows
+
+    def _cells_of(self, bounds):
+        min_x, min_y, max_x, max_y = bounds
+        for column in range(math.floor(min_x / self.cell_size), math.floor(max_x / self.cell_size) + 1):
+            for row in range(math.floor(min_y / self.cell_size), math.floor(max_y / self.cell_size) + 1):
+                yield (column, row)
+
+'''
+Return True if the 2 bounding boxes overlap (or touch)
+'''
+def boxes_overlap(bounds_a, bounds_b):
+    return bounds_a[0] <= bounds_b[2] and bounds_b[0] <= bounds_a[2] and bounds_a[1] <= bounds_b[3] and bounds_b[1] <= bounds_a[3]
@@ -1,38 +1,8 @@
-import math
-import numpy as np
 import matplotlib.pyplot as plt
 from scipy.interpolate import CubicSpline
 from shapely.geometry import Polygon
 
-def haversine_distance(lat1, lon1, lat2, lon2):
-    R = 6371.0  # Rayon de la Terre en km
-    dlat = np.radians(lat2 - lat1)
-    dlon = np.radians(lon2 - lon1)
-    a = np.sin(dlat / 2)**2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon / 2)**2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-    return R * c
-
-def move_point(lat, lon, distance, bearing):
-    R = 6371.0  # Rayon de la Terre en km
-    lat = np.radians(lat)
-    lon = np.radians(lon)
-    lat2 = np.arcsin(np.sin(lat) * np.cos(distance / R) + np.cos(lat) * np.sin(distance / R) * np.cos(bearing))
-    lon2 = lon + np.arctan2(np.sin(bearing) * np.sin(distance / R) * np.cos(lat), np.cos(distance / R) - np.sin(lat) * np.sin(lat2))
-    return np.degrees(lat2), np.degrees(lon2)
-
-def calculate_perpendicular(lat1, lon1, lat2, lon2, number_point, scale_km=0.1):
-    distance = haversine_distance(lat1, lon1, lat2, lon2)
-    bearing = math.atan2(lon2 - lon1, lat2 - lat1)
-
-    # Calculer le vecteur perpendiculaire (en radians)
-    perp_bearing1 = bearing + math.pi / 2
-    perp_bearing2 = bearing - math.pi / 2
-
-    # Calculer les points de la perpendiculaire
-    perp_point1 = move_point(lat2, lon2, number_point * scale_km, perp_bearing1)
-    perp_point2 = move_point(lat2, lon2, number_point * scale_km, perp_bearing2)
-
-    return perp_point1, perp_point2
+from geodesy import perpendicular_points
 
 def predict_next_points(gps_data, num_predictions=3, time_step=20, base_error_step=0.2):
     timestamps = sorted(gps_data.keys())
@@ -70,7 +40,7 @@ def predict_next_points(gps_data, num_predictions=3, time_step=20, base_error_st
         error_margin = base_error_step * (time_step / 5) / current_speed * i
         
         # Calculate perpendicular points
-        perp_point1, perp_point2 = calculate_perpendicular(prev_lat, prev_long, next_lat, next_lon, i, 0.0001)
+        perp_point1, perp_point2 = perpendicular_points(prev_lat, prev_long, next_lat, next_lon, i * 0.0001)
 
         print("prep : ", perp_point1, "\npoint", [next_lat, next_lon], "\nprep2 : ", perp_point2)
         
@@ -0,0 +1,235 @@
+import datetime
+import os
+import struct
+import threading
+import time
+import urllib.parse
+import numpy as np
+
+# Columns of the archive, one .npy file each (dates in seconds since the epoch)
+COLUMNS = {
+    'date': np.dtype('<f8'),
+    'latitude': np.dtype('<f8'),
+    'longitude': np.dtype('<f8'),
+    'speed': np.dtype('<f8'),
+    'acceleration_x': np.dtype('<f4'),
+    'acceleration_y': np.dtype('<f4'),
+    'acceleration_z': np.dtype('<f4'),
+    'battery': np.dtype('<f4'),
+    'temperature': np.dtype('<f4'),
+}
+
+# Size of the .npy header written by the archive: fixed, so the shape can be rewritten in place after an append
+HEADER_SIZE = 128
+
+#############################################################################################
+#                                     TRACK ARCHIVE                                         #
+#############################################################################################
+
+'''
+Columnar archive of the fixes of the fleet: one segment by day (UTC) and device, 'directory'/<day>/<device>/<column>.npy
+
+The fixes are buffered in memory and appended to the segments every 'flush_interval' seconds (or by flush()).
+In a segment the fixes are sorted by date, so the date column is the time index of the segment: a time range
+query memory-maps the columns, finds the range with a binary search on the dates and only reads that range
+'''
+class TrackArchive:
+    def __init__(self, directory, flush_interval=10):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        # device_id -> buffered fixes (tuples in the order of COLUMNS)
+        self._pending = {}
+        # device_id -> date of the last archived fix
+        self._last_dates = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    '''
+    Start the flush thread
+    '''
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='track-archive')
+        self._thread.daemon = True
+        self._thread.start()
+
+    '''
+    Buffer a fix of a device, written at the next flush (ValueError if the device id is empty, see safe_name)
+    '''
+    def append(self, device_id, date, latitude, longitude, speed, acceleration_x=np.nan, acceleration_y=np.nan, acceleration_z=np.nan, battery=np.nan, temperature=np.nan):
+        safe_name(device_id)
+        with self._lock:
+            self._pending.setdefault(device_id, []).append((date, latitude, longitude, speed, acceleration_x, acceleration_y, acceleration_z, battery, temperature))
+
+    '''
+    Append the buffered fixes to their segments, return the number of fixes written
+    '''
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        count = 0
+        with self._flush_lock:
+            for device_id, fixes in pending.items():
+                rows = np.array(fixes, dtype=np.float64)
+                rows = rows[np.argsort(rows[:, 0], kind='stable')]
+                days = np.array([day_of(date) for date in rows[:, 0]])
+                for day in np.unique(days):
+                    count += self._write_segment(device_id, day, rows[days == day])
+        return count
+
+    '''
+    Fixes of a device between 'start' and 'end' (dates in seconds, both included), as {column: array}
+
+    Only the segments of the days of the range are opened, and only the rows of the range are read
+    '''
+    def track(self, device_id, start, end, columns=None):
+        columns = list(COLUMNS) if columns is None else columns
+        parts = {column: [] for column in columns}
+        for day in days_between(start, end):
+            segment = self.segment(device_id, day)
+            if segment is None:
+                continue
+            first = np.searchsorted(segment['date'], start, side='left')
+            last = np.searchsorted(segment['date'], end, side='right')
+            if first >= last:
+                continue
+            for column in columns:
+                parts[column].append(np.array(segment[column][first:last]))
+        return {
+            column: np.concatenate(arrays) if len(arrays) > 0 else np.empty(0, dtype=COLUMNS[column])
+            for column, arrays in parts.items()
+        }
+
+    '''
+    Memory-mapped columns ({column: array}, read only) of the segment of a device for a day ('YYYY-MM-DD'),
+    or None if there is no segment
+    '''
+    def segment(self, device_id, day):
+        path = self._segment_path(device_id, day)
+        if not os.path.isdir(path):
+            return None
+        try:
+            arrays = {column: np.load(os.path.join(path, column + '.npy'), mmap_mode='r') for column in COLUMNS}
+        except (OSError, ValueError) as e:
+            print(f"Failed to open segment {path}: {e}")
+            return None
+        # the columns of a segment interrupted during an append may have more rows than the others
+        rows = min(len(array) for array in arrays.values())
+        return {column: array[:rows] for column, array in arrays.items()}
+
+    '''
+    Days ('YYYY-MM-DD') having segments
+    '''
+    def days(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, name)))
+
+    '''
+    Devices having a segment for a day
+    '''
+    def devices(self, day):
+        path = os.path.join(self.directory, day)
+        if not os.path.isdir(path):
+            return []
+        return sorted(device_id_of(name) for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to flush the track archive: {e}")
+
+    def _segment_path(self, device_id, day):
+        return os.path.join(self.directory, day, safe_name(device_id))
+
+    def _write_segment(self, device_id, day, rows):
+        path = self._segment_path(device_id, day)
+        os.makedirs(path, exist_ok=True)
+        files = [open_column(os.path.join(path, column + '.npy'), dtype) for column, dtype in COLUMNS.items()]
+        try:
+            # all columns are cut to the rows complete in every column (an append may have been interrupted)
+            count = min(rows_of(file) for file in files)
+            last_date = self._last_dates.get(device_id)
+            if count > 0:
+                files[0].seek(HEADER_SIZE + (count - 1) * COLUMNS['date'].itemsize)
+                last_date = float(np.frombuffer(files[0].read(COLUMNS['date'].itemsize), dtype=COLUMNS['date'])[0])
+            # the dates of a segment must stay sorted
+            if last_date is not None:
+                rows = rows[rows[:, 0] > last_date]
+            if len(rows) == 0:
+                return 0
+            # data first, then the headers: a reader never sees rows which are not written
+            for index, (file, dtype) in enumerate(zip(files, COLUMNS.values())):
+                file.seek(HEADER_SIZE + count * dtype.itemsize)
+                file.write(rows[:, index].astype(dtype).tobytes())
+                file.truncate()
+            for file, dtype in zip(files, COLUMNS.values()):
+                file.seek(0)
+                file.write(npy_header(dtype, count + len(rows)))
+            self._last_dates[device_id] = float(rows[-1, 0])
+            return len(rows)
+        finally:
+            for file in files:
+                file.close()
+
+'''
+.npy header (format 1.0) of a 1-D array of 'rows' values of 'dtype', padded to HEADER_SIZE bytes
+'''
+def npy_header(dtype, rows):
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (dtype.str, rows)
+    # magic (6 bytes), version (2 bytes), length of the header (2 bytes), header ended by a new line
+    header = header.ljust(HEADER_SIZE - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+'''
+Open a column for appending (created empty if needed)
+'''
+def open_column(path, dtype):
+    if not os.path.exists(path):
+        with open(path, 'wb') as file:
+            file.write(npy_header(dtype, 0))
+    return open(path, 'r+b')
+
+'''
+Number of rows of a column, from its header
+'''
+def rows_of(file):
+    file.seek(0)
+    np.lib.format.read_magic(file)
+    shape, _, _ = np.lib.format.read_array_header_1_0(file)
+    return shape[0]
+
+'''
+Day (UTC, 'YYYY-MM-DD') of a date in seconds
+'''
+def day_of(date):
+    return datetime.datetime.fromtimestamp(float(date), datetime.timezone.utc).strftime('%Y-%m-%d')
+
+'''
+Days ('YYYY-MM-DD') from the day of 'start' to the day of 'end'
+'''
+def days_between(start, end):
+    first = datetime.datetime.fromtimestamp(float(start), datetime.timezone.utc).date()
+    last = datetime.datetime.fromtimestamp(float(end), datetime.timezone.utc).date()
+    return [(first + datetime.timedelta(days=offset)).isoformat() for offset in range((last - first).days + 1)]
+
+'''
+Name of a device usable as a directory name, one name by device (percent-encoded, reversed by device_id_of)
+
+The dots are encoded too, so a name is never '.' or '..'. Raise ValueError if the device id is empty
+'''
+def safe_name(device_id):
+    if str(device_id) == '':
+        raise ValueError("Empty device id")
+    return urllib.parse.quote(str(device_id), safe='').replace('.', '%2E')
+
+'''
+Device id of a directory name given by safe_name
+'''
+def device_id_of(name):
+    return urllib.parse.unquote(name)
@@ -0,0 +1,242 @@
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+
+COLUMNS = ('date', 'latitude', 'longitude', 'speed')
+
+# Longest device id (UTF-8 bytes) of the fixed size records (write-ahead log, shared fleet snapshot)
+DEVICE_ID_MAX_BYTES = 64
+
+'''
+Device id encoded for a fixed size record
+
+Raise ValueError if it is longer than DEVICE_ID_MAX_BYTES: a truncated id could merge 2 devices
+'''
+def encode_device_id(device_id):
+    encoded = str(device_id).encode()
+    if len(encoded) > DEVICE_ID_MAX_BYTES:
+        raise ValueError(f"Device id {device_id!r} is longer than {DEVICE_ID_MAX_BYTES} bytes")
+    return encoded
+
+#############################################################################################
+#                                          TRACK                                            #
+#############################################################################################
+
+'''
+Fixed capacity ring buffer of the fixes of a device, one float64 row by column of COLUMNS
+
+Each fix is written twice (at its position and at position + capacity), so the fixes
+in the buffer are always contiguous: view() returns them without any copy, oldest first.
+Appending and evicting a fix are O(1)
+'''
+class Track:
+    __slots__ = ('capacity', '_buffer', '_start', '_size')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffer = np.empty((len(COLUMNS), 2 * capacity), dtype=np.float64)
+        self._start = 0
+        self._size = 0
+
+    '''
+    Add a fix at the end of the track, the oldest fix is dropped when the track is full
+    '''
+    def append(self, date, latitude, longitude, speed):
+        if self._size == self.capacity:
+            self._drop(1)
+        position = (self._start + self._size) % self.capacity
+        self._buffer[:, position] = self._buffer[:, position + self.capacity] = (date, latitude, longitude, speed)
+        self._size += 1
+
+    '''
+    Drop the fixes older than 'date'
+    '''
+    def evict_before(self, date):
+        self._drop(int(np.searchsorted(self._buffer[0, self._start:self._start + self._size], date)))
+
+    '''
+    Date of the most recent fix (None if the track is empty)
+    '''
+    def last_date(self):
+        if self._size == 0:
+            return None
+        return self._buffer[0, self._start + self._size - 1]
+
+    '''
+    The fixes as a (len(COLUMNS), n) array, oldest first (no copy, only valid until the next append)
+    '''
+    def view(self):
+        return self._buffer[:, self._start:self._start + self._size]
+
+    def __len__(self):
+        return self._size
+
+    def _drop(self, count):
+        count = min(count, self._size)
+        self._start = (self._start + count) % self.capacity
+        self._size -= count
+
+'''
+Frozen copy of the fixes of a device, one array by column (oldest first)
+'''
+class TrackSnapshot:
+    __slots__ = COLUMNS
+
+    def __init__(self, columns):
+        self.date, self.latitude, self.longitude, self.speed = columns
+
+    '''
+    Most recent fix as a dict
+    '''
+    def last(self):
+        return {name: float(getattr(self, name)[-1]) for name in COLUMNS}
+
+    def __len__(self):
+        return len(self.date)
+
+#############################################################################################
+#                                       TRACK STORE                                         #
+#############################################################################################
+
+'''
+In-memory history of the fleet, fed by the MQTT uplinks
+
+Each device keeps its last fixes ('date', 'latitude', 'longitude', 'speed') in a
+bounded time window, so the collision and state checks can read the recent
+positions of every boat without any request on Prometheus
+'''
+class TrackStore:
+    def __init__(self, window_seconds=120, max_points=32, max_devices=1000):
+        self.window_seconds = window_seconds
+        self.max_points = max_points
+        self.max_devices = max_devices
+        # device_id -> Track
+        self._tracks = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    Add a new fix to the track of 'device_id'
+
+    Fixes older or equal to the last known date of the device are ignored (duplicates)
+    '''
+    def add_fix(self, device_id, date, latitude, longitude, speed):
+        date = float(date)
+        with self._lock:
+            track = self._tracks.get(device_id)
+            if track is None:
+                track = Track(self.max_points)
+                self._tracks[device_id] = track
+            elif len(track) > 0 and track.last_date() >= date:
+                return False
+            track.append(date, float(latitude), float(longitude), float(speed))
+            self._tracks.move_to_end(device_id)
+
+            # forget the devices which have not reported for the longest time
+            while len(self._tracks) > self.max_devices:
+                self._tracks.popitem(last=False)
+        return True
+
+    '''
+    Return the fixes of 'device_id' in the time window (TrackSnapshot), or None if there is none
+    '''
+    def get_track(self, device_id, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            track = self._tracks.get(device_id)
+            if track is None:
+                return None
+            return self._window(track, now)
+
+    '''
+    Return the most recent fix of 'device_id', or None if the device is unknown
+    '''
+    def last_fix(self, device_id):
+        with self._lock:
+            track = self._tracks.get(device_id)
+            if track is None or len(track) == 0:
+                return None
+            return dict(zip(COLUMNS, track.view()[:, -1].tolist()))
+
+    '''
+    Return the tracks (TrackSnapshot) of all devices having at least one fix in the time window
+    '''
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        devices_data = {}
+        with self._lock:
+            for device_id, track in self._tracks.items():
+                data = self._window(track, now)
+                if data is not None:
+                    devices_data[device_id] = data
+        return devices_data
+
+    '''
+    Seed the store with an history organized by device, as columnar arrays
+    ({device_id: {'date': [...], 'latitude': [...], 'longitude': [...], 'speed': [...]}})
+    '''
+    def warm(self, devices_data):
+        count = 0
+        for device_id, data in devices_data.items():
+            for i in np.argsort(data['date']):
+                if self.add_fix(device_id, data['date'][i], data['latitude'][i], data['longitude'][i], data['speed'][i]):
+                    count += 1
+        return count
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tracks)
+
+    def _window(self, track, now):
+        # drop the fixes which went out of the time window
+        track.evict_before(now - self.window_seconds)
+        if len(track) == 0:
+            return None
+        # a single copy of the track block, the snapshot stays valid while the workers append new fixes
+        return TrackSnapshot(track.view().copy())
+
+#############################################################################################
+#                                     LAST FIX CACHE                                        #
+#############################################################################################
+
+'''
+Last known fix ('date', 'latitude', 'longitude') of each device
+
+Used to calculate distance and speed from the previous position, kept up to date
+by the consumer itself so Prometheus is only requested on cold start
+'''
+class LastFixCache:
+    def __init__(self, max_devices=1000):
+        self.max_devices = max_devices
+        self._fixes = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    Return the last fix of 'device_id', or None if the device is unknown
+    '''
+    def get(self, device_id):
+        with self._lock:
+            fix = self._fixes.get(device_id)
+            return None if fix is None else dict(fix)
+
+    '''
+    Replace the last fix of 'device_id' (a fix older than the cached one is ignored)
+    '''
+    def update(self, device_id, date, latitude, longitude):
+        with self._lock:
+            fix = self._fixes.get(device_id)
+            if fix is not None and fix['date'] > float(date):
+                return
+            self._fixes[device_id] = {
+                'date': float(date),
+                'latitude': float(latitude),
+                'longitude': float(longitude)
+            }
+            self._fixes.move_to_end(device_id)
+
+            while len(self._fixes) > self.max_devices:
+                self._fixes.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._fixes)
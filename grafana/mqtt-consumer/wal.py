@@ -0,0 +1,204 @@
+import os
+import threading
+import time
+import numpy as np
+
+from track_store import DEVICE_ID_MAX_BYTES, encode_device_id
+
+MAGIC = b'SHIPWAL1'
+
+# One fixed size record by decoded uplink (little endian)
+RECORD_DTYPE = np.dtype([
+    ('device_id', f'S{DEVICE_ID_MAX_BYTES}'),
+    ('date', '<f8'),
+    ('latitude', '<f8'),
+    ('longitude', '<f8'),
+    ('speed', '<f8'),
+    ('acceleration_x', '<f4'),
+    ('acceleration_y', '<f4'),
+    ('acceleration_z', '<f4'),
+    ('battery', '<f4'),
+    ('temperature', '<f4'),
+])
+
+# Header of the file: magic and size of a record (a log written with another format is not read)
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('record_size', '<u4'), ('reserved', '<u4')])
+
+#############################################################################################
+#                                    WRITE-AHEAD LOG                                        #
+#############################################################################################
+
+'''
+Append-only binary log of the decoded uplinks, to rebuild the track state after a restart
+
+Each uplink is one fixed size record (RECORD_DTYPE) appended to the file, so the log is read back
+by memory-mapping it as a NumPy structured array, without parsing. A record cut by a crash at the
+end of the file is ignored. The log is compacted every 'compact_interval' seconds: only the records
+of the time window and the last record of each device are kept (written to a new file, then renamed)
+'''
+class WriteAheadLog:
+    def __init__(self, path, window_seconds=120, compact_interval=300, fsync_interval=1.0):
+        self.path = path
+        self.window_seconds = window_seconds
+        self.compact_interval = compact_interval
+        self.fsync_interval = fsync_interval
+        self._file = None
+        self._last_fsync = 0.0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    '''
+    Open the log for appending (created if needed)
+    '''
+    def open(self):
+        with self._lock:
+            if self._file is not None:
+                return
+            directory = os.path.dirname(self.path)
+            if directory != '':
+                os.makedirs(directory, exist_ok=True)
+            if not self._valid_file(self.path):
+                write_log(self.path, np.empty(0, dtype=RECORD_DTYPE))
+            self._file = open(self.path, 'ab')
+            self._truncate_partial_record()
+
+    '''
+    Start the background compaction
+    '''
+    def start(self):
+        self.open()
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='wal-compaction')
+        self._thread.daemon = True
+        self._thread.start()
+
+    '''
+    Append a decoded uplink to the log (ValueError if the device id is too long, see encode_device_id)
+    '''
+    def append(self, device_id, date, latitude, longitude, speed, acceleration_x=np.nan, acceleration_y=np.nan, acceleration_z=np.nan, battery=np.nan, temperature=np.nan):
+        record = np.array([(encode_device_id(device_id), date, latitude, longitude, speed, acceleration_x, acceleration_y, acceleration_z, battery, temperature)], dtype=RECORD_DTYPE)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(record.tobytes())
+            self._file.flush()
+            # the records reach the disk at most every 'fsync_interval' seconds
+            now = time.monotonic()
+            if now - self._last_fsync >= self.fsync_interval:
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+
+    '''
+    The records of the log (memory-mapped, read only), oldest first
+    '''
+    def records(self):
+        return read_log(self.path)
+
+    '''
+    Rebuild the recent history from the log
+
+    Return ({device_id: {'date': [...], 'latitude': [...], 'longitude': [...], 'speed': [...]}} of the
+    records in the time window, {device_id: last record} of all devices)
+    '''
+    def recover(self, now=None):
+        now = time.time() if now is None else now
+        records = self.records()
+        if len(records) == 0:
+            return {}, {}
+
+        devices, inverse = np.unique(records['device_id'], return_inverse=True)
+        # stable sort by device then date: the records of a device are contiguous and sorted
+        order = np.lexsort((records['date'], inverse))
+        sorted_records = records[order]
+        boundaries = np.searchsorted(inverse[order], np.arange(len(devices) + 1))
+
+        devices_data = {}
+        last_records = {}
+        for index, device in enumerate(devices):
+            device_records = sorted_records[boundaries[index]:boundaries[index + 1]]
+            device_id = device.decode()
+            last_records[device_id] = device_records[-1]
+            recent = device_records[device_records['date'] >= now - self.window_seconds]
+            if len(recent) > 0:
+                devices_data[device_id] = {name: recent[name] for name in ('date', 'latitude', 'longitude', 'speed')}
+        return devices_data, last_records
+
+    '''
+    Keep only the records of the time window and the last record of each device
+    '''
+    def compact(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            records = read_log(self.path)
+            if len(records) == 0:
+                return 0
+            keep = records['date'] >= now - self.window_seconds
+            # last record of each device (np.unique gives the first index, on the reversed records)
+            _, last = np.unique(records['device_id'][::-1], return_index=True)
+            keep[len(records) - 1 - last] = True
+            compacted = np.array(records[keep])
+            dropped = len(records) - len(compacted)
+            del records
+
+            if self._file is not None:
+                self._file.close()
+            temporary = self.path + '.compact'
+            write_log(temporary, compacted)
+            os.replace(temporary, self.path)
+            if self._file is not None:
+                self._file = open(self.path, 'ab')
+            return dropped
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _run(self):
+        while True:
+            time.sleep(self.compact_interval)
+            try:
+                dropped = self.compact()
+                print(f"Write-ahead log compacted: {dropped} records dropped")
+            except Exception as e:
+                print(f"Failed to compact the write-ahead log: {e}")
+
+    def _valid_file(self, path):
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER_DTYPE.itemsize:
+            return False
+        header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)[0]
+        return header['magic'] == MAGIC and header['record_size'] == RECORD_DTYPE.itemsize
+
+    def _truncate_partial_record(self):
+        # a record cut by a crash would shift all the next records
+        size = os.path.getsize(self.path)
+        extra = (size - HEADER_DTYPE.itemsize) % RECORD_DTYPE.itemsize
+        if extra != 0:
+            self._file.truncate(size - extra)
+
+'''
+Memory-map the records of a log file (empty array if the file is missing or has another format)
+'''
+def read_log(path):
+    if not os.path.exists(path) or os.path.getsize(path) < HEADER_DTYPE.itemsize:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)[0]
+    if header['magic'] != MAGIC or header['record_size'] != RECORD_DTYPE.itemsize:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    count = (os.path.getsize(path) - HEADER_DTYPE.itemsize) // RECORD_DTYPE.itemsize
+    if count == 0:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_DTYPE.itemsize, shape=(count,))
+
+'''
+Write a complete log file (header and records), flushed to the disk
+'''
+def write_log(path, records):
+    header = np.array([(MAGIC, RECORD_DTYPE.itemsize, 0)], dtype=HEADER_DTYPE)
+    with open(path, 'wb') as file:
+        file.write(header.tobytes())
+        file.write(np.ascontiguousarray(records, dtype=RECORD_DTYPE).tobytes())
+        file.flush()
+        os.fsync(file.fileno())
@@ -0,0 +1,233 @@
+from shapely.geometry import Point, Polygon
+from shapely.strtree import STRtree
+import shapely
+import numpy as np
+import threading
+import time
+import re
+
+from http_client import HttpClient
+
+GEOJSON_PATTERN = re.compile(r".+\.geojson", re.IGNORECASE)
+
+# Function to round coordinates to 7 decimal places
+def round_coordinates(coordinates, precision=7):
+    return [[round(coord[0], precision), round(coord[1], precision)] for coord in coordinates]
+
+'''
+Build the list of zones (zone_id, Polygon) of a geojson file
+
+The zone id is the 'name' or 'id' property of the feature, or '<file>#<index>' by default
+'''
+def build_zones(file_name, data):
+    zones = []
+    for index, feature in enumerate(data["features"]):
+        if feature['geometry']['type'] != 'Polygon':
+            continue
+        properties = feature.get('properties') or {}
+        zone_id = properties.get('name', properties.get('id', file_name + '#' + str(index)))
+        #only process first zone
+        polygon_coordinates = feature['geometry']['coordinates'][0]
+        rounded_polygon_coordinates = round_coordinates(polygon_coordinates)
+        zones.append((str(zone_id), Polygon(rounded_polygon_coordinates)))
+    return zones
+
+#############################################################################################
+#                                        ZONE INDEX                                         #
+#############################################################################################
+
+'''
+Bounding-box spatial index (STRtree) over prepared polygons of the zones
+
+A lookup only tests the polygons whose bounding box contains the point
+'''
+class ZoneIndex:
+    def __init__(self, zones):
+        self.zones = tuple(zones)
+        self.zone_ids = [zone_id for zone_id, polygon in self.zones]
+        self.polygons = [polygon for zone_id, polygon in self.zones]
+        for polygon in self.polygons:
+            shapely.prepare(polygon)
+        self.tree = STRtree(self.polygons)
+
+    '''
+    Return the ids of all zones containing the point
+    '''
+    def query(self, lat, lon):
+        point = Point(lon, lat)  # Note: Point takes (x, y) which corresponds to (lon, lat)
+        # the tree only gives the candidates by bounding box: a predicate of the tree would prepare the point,
+        # not the polygons, so the exact test is done on the prepared polygons
+        indexes = self.tree.query(point)
+        return [self.zone_ids[index] for index in sorted(indexes) if self.polygons[index].contains(point)]
+
+    '''
+    Return a boolean array telling for each (latitude, longitude) if it is in one of the zones
+
+    Vectorized over the points: each zone only tests the points inside its bounding box
+    '''
+    def contains_batch(self, latitudes, longitudes):
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        inside = np.zeros(latitudes.shape, dtype=bool)
+        for polygon in self.polygons:
+            min_lon, min_lat, max_lon, max_lat = polygon.bounds
+            candidates = np.flatnonzero(~inside & (longitudes >= min_lon) & (longitudes <= max_lon) & (latitudes >= min_lat) & (latitudes <= max_lat))
+            if len(candidates) == 0:
+                continue
+            inside[candidates] = shapely.contains_xy(polygon, longitudes[candidates], latitudes[candidates])
+        return inside
+
+    def __len__(self):
+        return len(self.zones)
+
+#############################################################################################
+#                                      ZONE REGISTRY                                        #
+#############################################################################################
+
+'''
+Zones (geojson files served by nginx) loaded once and kept in memory
+
+A background thread polls the nginx listing and only downloads again the files
+which changed (ETag / Last-Modified), the lookups never touch the network
+'''
+class ZoneRegistry:
+    def __init__(self, nginx_url, refresh_interval=60, on_reload=None, http_client=None):
+        self.nginx_url = nginx_url
+        self.refresh_interval = refresh_interval
+        self.http = HttpClient() if http_client is None else http_client
+        self.on_reload = on_reload
+        self.version = 0
+        self.loaded_at = 0.0
+        # file name -> {'etag', 'last_modified', 'mtime', 'zones'}
+        self._files = {}
+        self._index = ZoneIndex(())
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    '''
+    Current zones, as a tuple of (zone_id, Polygon)
+    '''
+    @property
+    def zones(self):
+        return self.index.zones
+
+    '''
+    Spatial index of the current zones
+    '''
+    @property
+    def index(self):
+        if not self._loaded:
+            self.refresh()
+        return self._index
+
+    '''
+    Reload the zones which changed on nginx
+
+    Return True if the zones changed (a new version is published)
+    '''
+    def refresh(self):
+        with self._lock:
+            self._loaded = True
+            try:
+                res = self.http.get('nginx', self.nginx_url + '/list_files/')
+                res.raise_for_status()
+                list_files = res.json()
+            except Exception as e:
+                print(f"Failed to fetch data from NGINX: {e}")
+                return False
+
+            changed = False
+            files = {}
+            for file in list_files:
+                if file["type"] != "file":
+                    continue
+                if GEOJSON_PATTERN.match(file["name"]) == None:
+                    continue
+                cached = self._files.get(file["name"])
+                entry = self._fetch_file(file, cached)
+                if entry is None:
+                    # keep the last known version of the file if it can not be fetched
+                    if cached is not None:
+                        files[file["name"]] = cached
+                    continue
+                if entry is not cached:
+                    changed = True
+                files[file["name"]] = entry
+
+            if files.keys() != self._files.keys():
+                changed = True
+
+            self._files = files
+            if changed:
+                self._index = ZoneIndex(zone for name in sorted(files) for zone in files[name]['zones'])
+                self.version += 1
+                self.loaded_at = time.time()
+                print(f"Zones reloaded: version {self.version}, {len(self._index)} zones")
+                if self.on_reload is not None:
+                    self.on_reload(self)
+            return changed
+
+    '''
+    Start the background thread refreshing the zones every 'refresh_interval' seconds
+    '''
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='zone-registry')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    '''
+    Return the ids of all zones containing the point
+    '''
+    def zone_ids_at(self, lat, lon):
+        return self.index.query(lat, lon)
+
+    '''
+    Return True if the point is in one of the zones
+    '''
+    def contains(self, lat, lon):
+        return len(self.zone_ids_at(lat, lon)) > 0
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Failed to refresh zones: {e}")
+
+    '''
+    Download a geojson file, unless nginx answers it did not change since the cached version
+
+    Return the cached entry if unchanged, a new entry if changed, None on error
+    '''
+    def _fetch_file(self, file, cached):
+        headers = {}
+        if cached is not None:
+            # nginx listing already gives the modification date of the file
+            if file.get("mtime") is not None and file.get("mtime") == cached['mtime']:
+                return cached
+            if cached['etag'] is not None:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified'] is not None:
+                headers['If-Modified-Since'] = cached['last_modified']
+        try:
+            res = self.http.get('nginx', self.nginx_url + '/data/' + file["name"], headers=headers)
+            if res.status_code == 304 and cached is not None:
+                cached['mtime'] = file.get("mtime")
+                return cached
+            res.raise_for_status()
+            return {
+                'etag': res.headers.get('ETag'),
+                'last_modified': res.headers.get('Last-Modified'),
+                'mtime': file.get("mtime"),
+                'zones': build_zones(file["name"], res.json())
+            }
+        except Exception as e:
+            print(f"Failed to fetch zone file {file['name']}: {e}")
+            return None